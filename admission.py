@@ -0,0 +1,173 @@
+"""
+Допуск запросов к модели.
+Одновременных запросов не больше ADMISSION_GLOBAL_LIMIT всего и ADMISSION_USER_LIMIT
+на пользователя. Остальные ждут по очереди, но не дольше дедлайна ответа;
+если ждущих уже ADMISSION_QUEUE_SIZE, новый запрос сразу получает отказ.
+Фоновые запросы (краткое содержание истории) идут в общий лимит, но с низким
+приоритетом: пропускают вперёд ждущих пользователей и не занимают последний слот.
+В лимит пользователя они не входят - его следующее сообщение не ждёт свёртку.
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import metrics
+
+# === КОНФИГУРАЦИЯ ===
+ADMISSION_GLOBAL_LIMIT = int(os.environ.get("ADMISSION_GLOBAL_LIMIT", 6))
+ADMISSION_USER_LIMIT = int(os.environ.get("ADMISSION_USER_LIMIT", 1))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", 32))
+REPLY_DEADLINE = float(os.environ.get("REPLY_DEADLINE", 90))  # Секунды от приёма обновления, позже ответ не нужен
+BUSY_NOTICE_INTERVAL = float(os.environ.get("BUSY_NOTICE_INTERVAL", 30))  # Не чаще одного «занят» на чат
+
+admissions = metrics.Counter("bot_admission_total", "Model call admission decisions", ["result"])
+
+
+class Overloaded(Exception):
+    """Запрос не допущен: reason - busy (очередь полна) или expired (дедлайн прошёл)"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class _Ticket:
+    __slots__ = ("user_id", "background", "held")
+
+    def __init__(self, user_id, background=False):
+        self.user_id = user_id
+        self.background = background
+        self.held = False
+
+
+class AdmissionController:
+    """Слоты для запросов к модели с ограничением на пользователя и очередью ожидания"""
+
+    def __init__(self, global_limit=ADMISSION_GLOBAL_LIMIT, user_limit=ADMISSION_USER_LIMIT,
+                 queue_size=ADMISSION_QUEUE_SIZE):
+        self.global_limit = global_limit
+        self.user_limit = user_limit
+        self.queue_size = queue_size
+        self._cond = threading.Condition()
+        self._active = 0
+        self._per_user = {}  # user_id -> запросов в работе
+        self._waiting = deque()
+        self._notices = {}  # chat_id -> время последнего «занят»
+
+    @contextmanager
+    def slot(self, user_id, deadline=None, background=False):
+        """
+        Занять слот на время запроса. deadline - по time.time(); Overloaded, если не дождались.
+        background=True - низкий приоритет: ждёт без ограничения очереди, пока есть место,
+        и не входит в лимит пользователя
+        """
+        ticket = _Ticket(user_id, background)
+        self._acquire(ticket, deadline)
+        try:
+            yield ticket
+        finally:
+            if not ticket.held:
+                self._release(ticket)
+
+    def hold(self, ticket):
+        """
+        Не освобождать слот при выходе из slot(). Возвращает функцию, которая освободит его позже -
+        когда закончатся все попытки запроса, включая проигравшие страхующие
+        """
+        ticket.held = True
+        once = threading.Lock()
+
+        def release():
+            if once.acquire(blocking=False):
+                self._release(ticket)
+        return release
+
+    def notice_due(self, chat_id):
+        """Пора ли снова сказать чату, что бот занят"""
+        now = time.monotonic()
+        with self._cond:
+            if now - self._notices.get(chat_id, -BUSY_NOTICE_INTERVAL) < BUSY_NOTICE_INTERVAL:
+                return False
+            if len(self._notices) > 10000:
+                self._notices = {c: t for c, t in self._notices.items() if now - t < BUSY_NOTICE_INTERVAL}
+            self._notices[chat_id] = now
+            return True
+
+    def stats(self):
+        with self._cond:
+            return {"active": self._active, "waiting": len(self._waiting), "active_users": len(self._per_user),
+                    "busy": admissions.value(result="busy"), "expired": admissions.value(result="expired")}
+
+    # --- внутреннее ---
+
+    def _release(self, ticket):
+        with self._cond:
+            self._active -= 1
+            if not ticket.background:
+                self._per_user[ticket.user_id] -= 1
+                if not self._per_user[ticket.user_id]:
+                    del self._per_user[ticket.user_id]
+            self._cond.notify_all()
+
+    def _user_has_room(self, ticket):
+        return ticket.background or self._per_user.get(ticket.user_id, 0) < self.user_limit
+
+    def _limit(self, ticket):
+        # Последний слот фоновым запросам не отдаём - пользователю всегда есть куда войти
+        if ticket.background and self.global_limit > 1:
+            return self.global_limit - 1
+        return self.global_limit
+
+    def _ahead(self, waiting, ticket):
+        """Может ли ждущий waiting занять слот раньше ticket"""
+        if waiting.background and not ticket.background:
+            return False
+        return self._user_has_room(waiting)
+
+    def _turn(self, ticket):
+        """Слот свободен и его не займёт никто из ждущих раньше, а фоновый - ещё и пропускает пользователей"""
+        if self._active >= self._limit(ticket) or not self._user_has_room(ticket):
+            return False
+        earlier = True
+        for waiting in self._waiting:
+            if waiting is ticket:
+                earlier = False
+            elif self._ahead(waiting, ticket) and (earlier or (ticket.background and not waiting.background)):
+                return False
+        return True
+
+    def _acquire(self, ticket, deadline):
+        with self._cond:
+            if deadline is not None and time.time() >= deadline:
+                admissions.inc(result="expired")
+                raise Overloaded("expired")
+            if (self._active < self._limit(ticket) and self._user_has_room(ticket)
+                    and not any(self._ahead(waiting, ticket) for waiting in self._waiting)):
+                self._take(ticket)
+                return
+            if not ticket.background and sum(not w.background for w in self._waiting) >= self.queue_size:
+                admissions.inc(result="busy")
+                raise Overloaded("busy")
+
+            self._waiting.append(ticket)
+            try:
+                while not self._turn(ticket):
+                    timeout = None if deadline is None else deadline - time.time()
+                    if timeout is not None and timeout <= 0:
+                        admissions.inc(result="expired")
+                        raise Overloaded("expired")
+                    self._cond.wait(timeout)
+            finally:
+                self._waiting.remove(ticket)
+                # Очередь сдвинулась - следующий мог получить право на слот
+                self._cond.notify_all()
+            self._take(ticket)
+
+    def _take(self, ticket):
+        self._active += 1
+        if not ticket.background:
+            self._per_user[ticket.user_id] = self._per_user.get(ticket.user_id, 0) + 1
+        admissions.inc(result="admitted")
@@ -0,0 +1 @@
+"""Нагрузочный тест бота на локальных заглушках Telegram и OpenRouter"""
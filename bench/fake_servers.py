@@ -0,0 +1,188 @@
+"""
+Локальные заглушки Telegram Bot API и OpenRouter для бенчмарка.
+Задержки, доля ошибок и стриминг настраиваются.
+"""
+
+import json
+import time
+import random
+import threading
+import itertools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Маленький JPEG 8x8 для фото от пользователей и картинок из ответов
+TINY_JPEG = bytes.fromhex(
+    "ffd8ffe000104a46494600010100000100010000ffdb004300100b0c0e0c0a100e0d0e1211101318281a181616183123"
+    "251d283a333d3c3933383740485c4e404457453738506d51575f626768673e4d71797064785c656763ffdb0043011112"
+    "121815182f1a1a2f63423842636363636363636363636363636363636363636363636363636363636363636363636363"
+    "6363636363636363636363636363ffc00011080008000803012200021101031101ffc4001f0000010501010101010100"
+    "000000000000000102030405060708090a0bffc400b5100002010303020403050504040000017d010203000411051221"
+    "31410613516107227114328191a1082342b1c11552d1f02433627282090a161718191a25262728292a3435363738393a"
+    "434445464748494a535455565758595a636465666768696a737475767778797a838485868788898a9293949596979899"
+    "9aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5c6c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1"
+    "f2f3f4f5f6f7f8f9faffc4001f0100030101010101010101010000000000000102030405060708090a0bffc400b51100"
+    "020102040403040705040400010277000102031104052131061241510761711322328108144291a1b1c109233352f015"
+    "6272d10a162434e125f11718191a262728292a35363738393a434445464748494a535455565758595a63646566676869"
+    "6a737475767778797a82838485868788898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4"
+    "c5c6c7c8c9cad2d3d4d5d6d7d8d9dae2e3e4e5e6e7e8e9eaf2f3f4f5f6f7f8f9faffda000c03010002110311003f006d"
+    "14515e59ec9fffd9"
+)
+
+
+class _Server:
+    """Общая обвязка: HTTP-сервер в фоновом потоке и счётчики запросов"""
+
+    def __init__(self, handler_class):
+        self.calls = {}
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(handler_class):
+            owner = server
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _BaseHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status, payload, content_type="application/json"):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _TelegramHandler(_BaseHandler):
+    owner = None
+
+    def do_GET(self):
+        # /file/bot<token>/<path> и картинки по [IMAGE:] URL
+        self.owner.count("download")
+        time.sleep(self.owner.latency)
+        self._send(200, TINY_JPEG, "image/jpeg")
+
+    def do_POST(self):
+        self._body()
+        method = self.path.rsplit("/", 1)[-1]
+        self.owner.count(method)
+        time.sleep(self.owner.latency)
+
+        if random.random() < self.owner.error_rate:
+            self._send(429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                             "parameters": {"retry_after": 1}})
+            return
+
+        message_id = next(self.owner.message_ids)
+        photo = [{"file_id": f"photo-{message_id}", "file_unique_id": f"u{message_id}", "width": 1, "height": 1}]
+        if method == "getFile":
+            result = {"file_id": "f", "file_path": f"photos/file_{message_id}.jpg"}
+        elif method == "sendMediaGroup":
+            result = [{"message_id": message_id, "photo": photo} for _ in range(2)]
+        elif method in ("sendPhoto", "sendDocument"):
+            result = {"message_id": message_id, "photo": photo}
+        elif method in ("sendMessage", "editMessageText"):
+            result = {"message_id": message_id}
+        elif method == "getUpdates":
+            result = []
+        else:
+            result = True
+        self._send(200, {"ok": True, "result": result})
+
+
+class FakeTelegram(_Server):
+    """Заглушка Bot API: отвечает на send*/getFile, отдаёт файлы"""
+
+    def __init__(self, latency=0.02, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.message_ids = itertools.count(1)
+        super().__init__(_TelegramHandler)
+
+
+class _OpenRouterHandler(_BaseHandler):
+    owner = None
+
+    def do_POST(self):
+        request = json.loads(self._body() or b"{}")
+        owner = self.owner
+        owner.count("completions")
+        time.sleep(owner.latency)
+
+        if random.random() < owner.error_rate:
+            self._send(random.choice([429, 500, 502]), {"error": {"message": "fake error"}})
+            return
+
+        text = owner.reply_text()
+        usage = {"prompt_tokens": 100 + len(request.get("messages", [])) * 20,
+                 "completion_tokens": len(text) // 3, "total_tokens": 0}
+
+        if not request.get("stream"):
+            self._send(200, {"choices": [{"message": {"role": "assistant", "content": text}}], "usage": usage})
+            return
+
+        # SSE: куски ответа с паузой между ними
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        self.wfile.write(b": OPENROUTER PROCESSING\n\n")
+        for i in range(0, len(text), owner.chunk_size):
+            chunk = {"choices": [{"delta": {"content": text[i:i + owner.chunk_size]}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(owner.chunk_delay)
+        self.wfile.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+class FakeOpenRouter(_Server):
+    """Заглушка OpenRouter: обычные и потоковые ответы, иногда с [IMAGE:] тегами"""
+
+    def __init__(self, latency=0.5, error_rate=0.0, chunk_size=20, chunk_delay=0.02,
+                 image_rate=0.1, image_base_url=None, reply_length=400):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.image_rate = image_rate
+        self.image_base_url = image_base_url
+        self.reply_length = reply_length
+        super().__init__(_OpenRouterHandler)
+
+    def reply_text(self):
+        text = ("Это тестовый ответ модели. " * (self.reply_length // 27 + 1))[:self.reply_length]
+        if self.image_base_url and random.random() < self.image_rate:
+            n = random.randint(1, 3)
+            tags = "".join(f"[IMAGE:{self.image_base_url}/img/{random.randint(1, 50)}.jpg|Картинка {i}]"
+                           for i in range(n))
+            text = f"{tags}\n{text}"
+        return text
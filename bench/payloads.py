@@ -0,0 +1,83 @@
+"""
+Генератор реалистичных обновлений Telegram для бенчмарка:
+текст, фото, команды и альбомы.
+"""
+
+import random
+import itertools
+
+TEXTS = [
+    "Привет",
+    "Как дела?",
+    "Нарисуй кота",
+    "Расскажи коротко про историю Рима",
+    "Переведи на английский: хорошего дня",
+    "Покажи фото заката",
+    "Что такое квантовый компьютер? Объясни простыми словами, с примерами и аналогиями.",
+]
+COMMANDS = ["/start", "/help", "/clear", "/image"]
+CAPTIONS = ["", "Что это?", "Опиши подробно", "Сколько тут людей?"]
+
+DEFAULT_MIX = {"text": 0.7, "photo": 0.15, "command": 0.1, "album": 0.05}
+
+
+class UpdateGenerator:
+    """Поток обновлений для заданного числа чатов"""
+
+    def __init__(self, chats=50, mix=None, seed=None):
+        self.chats = chats
+        self.mix = mix or DEFAULT_MIX
+        self.random = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._files = itertools.count(1)
+        self._groups = itertools.count(1)
+
+    def _message(self, chat_id, **fields):
+        message = {
+            "message_id": next(self._message_ids),
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"},
+            "chat": {"id": chat_id, "type": "private"},
+            "date": 0,
+        }
+        message.update(fields)
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def _photo_sizes(self):
+        n = next(self._files)
+        return [
+            {"file_id": f"file-{n}-{w}", "file_unique_id": f"uniq-{n}-{w}", "width": w, "height": w * 3 // 4}
+            for w in (90, 320, 800, 1280)
+        ]
+
+    def text(self, chat_id):
+        return [self._message(chat_id, text=self.random.choice(TEXTS))]
+
+    def command(self, chat_id):
+        return [self._message(chat_id, text=self.random.choice(COMMANDS))]
+
+    def photo(self, chat_id):
+        return [self._message(chat_id, photo=self._photo_sizes(), caption=self.random.choice(CAPTIONS))]
+
+    def album(self, chat_id):
+        group_id = str(next(self._groups))
+        caption = self.random.choice(CAPTIONS)
+        updates = []
+        for i in range(self.random.randint(2, 4)):
+            fields = {"photo": self._photo_sizes(), "media_group_id": group_id}
+            if i == 0 and caption:
+                fields["caption"] = caption
+            updates.append(self._message(chat_id, **fields))
+        return updates
+
+    def next(self):
+        """Следующая порция обновлений (альбом - несколько обновлений подряд)"""
+        chat_id = self.random.randint(1, self.chats)
+        kind = self.random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        return getattr(self, kind)(chat_id)
+
+    def generate(self, count):
+        updates = []
+        while len(updates) < count:
+            updates.extend(self.next())
+        return updates[:count]
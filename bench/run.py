@@ -0,0 +1,199 @@
+"""
+Нагрузочный тест webhook() на локальных заглушках Telegram и OpenRouter.
+
+    python -m bench.run --updates 500 --rate 50 --output bench_output.txt
+    python -m bench.run --compare baseline.json   # ненулевой код при регрессии
+
+Печатает JSON: задержки ответа вебхука и полной обработки (p50/p95/p99),
+обновлений в секунду и рост памяти процесса.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fake_servers import FakeTelegram, FakeOpenRouter
+from bench.payloads import UpdateGenerator
+
+
+def rss_mb():
+    """Текущий RSS процесса в МБ"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(values[-1] * 1000, 2)}
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        kind, weight = part.split("=")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def configure_environment(args, telegram, openrouter, data_dir):
+    """Направить бота на заглушки. Вызывать до импорта bot"""
+    os.environ.update({
+        "TELEGRAM_TOKEN": "bench",
+        "OPENROUTER_API_KEY": "bench",
+        "TELEGRAM_API_URL": telegram.url,
+        "OPENROUTER_URL": f"{openrouter.url}/api/v1/chat/completions",
+        "BOT_DATA_DIR": data_dir,
+        "STREAM_RESPONSES": "1" if args.stream else "0",
+    })
+    if args.no_rate_limit:
+        # Меряем сам конвейер, а не лимиты Telegram
+        os.environ.update({"TG_GLOBAL_RATE": "100000", "TG_GLOBAL_BURST": "100000",
+                           "TG_CHAT_RATE": "100000", "TG_CHAT_BURST": "100000",
+                           "TG_GROUP_RATE": "100000", "TG_GROUP_BURST": "100000"})
+
+
+def run(args):
+    telegram = FakeTelegram(latency=args.telegram_latency, error_rate=args.telegram_error_rate).start()
+    openrouter = FakeOpenRouter(latency=args.llm_latency, error_rate=args.llm_error_rate,
+                                chunk_delay=args.chunk_delay, image_rate=args.image_rate,
+                                image_base_url=telegram.url).start()
+    data_dir = tempfile.mkdtemp(prefix="bot-bench-")
+    configure_environment(args, telegram, openrouter, data_dir)
+
+    import bot
+
+    # Время завершения обработки каждого обновления
+    started = {}
+    finished = {}
+    lock = threading.Lock()
+    handler = bot.dispatcher.handler
+
+    def timed_handler(jobs):
+        try:
+            handler(jobs)
+        finally:
+            with lock:
+                for update, _ in jobs:
+                    finished[update["update_id"]] = time.monotonic()
+
+    bot.dispatcher.handler = timed_handler
+
+    updates = UpdateGenerator(chats=args.chats, mix=parse_mix(args.mix), seed=args.seed).generate(args.updates)
+    client = bot.app.test_client()
+    ack_latencies = []
+    errors = []
+
+    def post(update, scheduled):
+        delay = scheduled - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        start = time.monotonic()
+        with lock:
+            started[update["update_id"]] = start
+        response = client.post("/webhook", json=update)
+        with lock:
+            ack_latencies.append(time.monotonic() - start)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+    rss_start = rss_mb()
+    t0 = time.monotonic()
+    interval = 1.0 / args.rate if args.rate else 0
+    with ThreadPoolExecutor(max_workers=args.senders) as senders:
+        for i, update in enumerate(updates):
+            senders.submit(post, update, t0 + i * interval)
+    bot.coalescer.wait_idle(timeout=args.drain_timeout)
+    bot.dispatcher.wait_idle(timeout=args.drain_timeout)
+    duration = time.monotonic() - t0
+    rss_end = rss_mb()
+
+    e2e = [finished[uid] - started[uid] for uid in finished if uid in started]
+    result = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "updates_sent": len(updates),
+        "updates_completed": len(e2e),
+        "webhook_errors": len(errors),
+        "duration_s": round(duration, 3),
+        "throughput_updates_per_s": round(len(e2e) / duration, 2) if duration else None,
+        "ack_latency_ms": percentiles(ack_latencies),
+        "e2e_latency_ms": percentiles(e2e),
+        "memory_mb": {"rss_start": round(rss_start, 1), "rss_end": round(rss_end, 1),
+                      "growth": round(rss_end - rss_start, 1)},
+        "upstream_calls": {"telegram": telegram.calls, "openrouter": openrouter.calls},
+    }
+
+    telegram.stop()
+    openrouter.stop()
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """Список регрессий относительно сохранённого результата"""
+    problems = []
+    for section in ("e2e_latency_ms", "ack_latency_ms"):
+        for key in ("p50", "p95", "p99"):
+            old, new = baseline[section].get(key), result[section].get(key)
+            if old and new and new > old * (1 + tolerance):
+                problems.append(f"{section}.{key}: {old} -> {new}")
+    old, new = baseline.get("throughput_updates_per_s"), result.get("throughput_updates_per_s")
+    if old and new and new < old * (1 - tolerance):
+        problems.append(f"throughput_updates_per_s: {old} -> {new}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк webhook() на локальных заглушках")
+    parser.add_argument("--updates", type=int, default=300)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=0, help="Обновлений в секунду (0 - без ограничения)")
+    parser.add_argument("--senders", type=int, default=16, help="Параллельных отправителей вебхуков")
+    parser.add_argument("--mix", default="text=0.7,photo=0.15,command=0.1,album=0.05")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--stream", action="store_true", help="Стриминг ответов OpenRouter")
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--chunk-delay", type=float, default=0.01)
+    parser.add_argument("--image-rate", type=float, default=0.1)
+    parser.add_argument("--telegram-latency", type=float, default=0.01)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0)
+    parser.add_argument("--no-rate-limit", action="store_true", help="Отключить лимиты Telegram в планировщике")
+    parser.add_argument("--drain-timeout", type=float, default=300)
+    parser.add_argument("--output", help="Записать JSON в файл")
+    parser.add_argument("--compare", help="JSON прошлого прогона для проверки регрессий")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    result = run(args)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            problems = compare(result, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION {problem}", file=sys.stderr)
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
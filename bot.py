@@ -5,75 +5,188 @@ Telegram бот с поддержкой фото через OpenRouter и пам
 """
 
 import os
+import re
+import html
 import json
-import base64
-from flask import Flask, request, jsonify
+import time
+import threading
+from flask import Flask, Response, request, jsonify
 import logging
-import requests
-from collections import defaultdict
 from io import BytesIO
 import mimetypes
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import http_client
+import metrics
+from dispatcher import ChatDispatcher, CHAT_MAX_PENDING
+from admission import AdmissionController, Overloaded, REPLY_DEADLINE
+from model_router import ModelRouter
+from response_cache import ResponseCache, RESPONSE_CACHE_PATH
+from prompt import build_messages, serialize_request
+from dedup import UpdateDedup
+from coalescer import Coalescer, message_group_key, COALESCE_MAX_ITEMS
+from shared_state import SharedUpdateQueue, ShardConsumer, shard_for
+from history_store import create_history_store, history_key
+from media import (choose_photo_size, prepare_image, is_image, source_digest, image_placeholder,
+                   LocalFile, DataUrlJSONBody, MultipartBody, CHUNK_SIZE, DOWNLOAD_MAX_BYTES)
+from file_cache import FileCache, FileIdMap
+from rate_limiter import OutboundScheduler, PRIORITY_REPLY, PRIORITY_EDIT
+from formatting import render_chunks, deliver_text, deliver_chunks, utf16_prefix, TELEGRAM_TEXT_LIMIT
 
 app = Flask(__name__)
 
 # === КОНФИГУРАЦИЯ ===
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
+# Адреса API можно переопределить (например, на локальные заглушки для бенчмарка)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+OPENROUTER_URL = os.environ.get("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+http_client.register_hosts(TELEGRAM_API_URL, OPENROUTER_URL)
 MODEL = "openai/gpt-5.1-codex-mini"  # Модель которая понимает картинки
+# Пулы моделей через запятую; для фото нужны модели, которые понимают картинки
+TEXT_MODELS = [m.strip() for m in os.environ.get("TEXT_MODELS", MODEL).split(",") if m.strip()]
+VISION_MODELS = [m.strip() for m in os.environ.get("VISION_MODELS", MODEL).split(",") if m.strip()]
+BOT_MODE = os.environ.get("BOT_MODE", "webhook")  # webhook | polling
+POLLING_TIMEOUT = int(os.environ.get("POLLING_TIMEOUT", 30))  # Секунды long polling
+POLLING_BATCH = int(os.environ.get("POLLING_BATCH", 100))  # Обновлений за один getUpdates
+# Несколько процессов (gunicorn): обновления идут через общую очередь с шардами по чату
+SHARED_STATE = os.environ.get("BOT_SHARED_STATE", "0") == "1"
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # === ПАМЯТЬ ДИАЛОГА ===
-conversation_history = defaultdict(list)
-MAX_HISTORY = 10  # Сохранять последние 10 сообщений (5 пар вопрос-ответ)
+# История ограничена бюджетом токенов, более ранние сообщения сворачиваются в краткое содержание
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", 2000))
+HISTORY_MAX_MESSAGES = int(os.environ.get("HISTORY_MAX_MESSAGES", 40))  # Жёсткий предел числа сообщений
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", 300))
+
+# === СТРИМИНГ ОТВЕТОВ ===
+STREAM_RESPONSES = os.environ.get("STREAM_RESPONSES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.5))  # Telegram ограничивает частоту правок
+
+# === ИЗОБРАЖЕНИЯ В ОТВЕТАХ ===
+MAX_IMAGES_PER_REPLY = 3
+IMAGE_FETCH_DEADLINE = float(os.environ.get("IMAGE_FETCH_DEADLINE", 15))  # Общий дедлайн на все загрузки
+media_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("MEDIA_THREADS", 8)),
+                                    thread_name_prefix="media")
+
+# Скачанные файлы на диске и file_id уже отправленных картинок
+file_cache = FileCache()
+file_ids = FileIdMap()
+
+# Паттерн для поиска [IMAGE:URL|описание] или [IMAGE:URL]
+IMAGE_TAG_PATTERN = re.compile(r'\[IMAGE:(https?://[^\s\|\[\]]+)(?:\|([^\]]+))?\]')
+
+# === ВЫБОР МОДЕЛИ ===
+# Самая быстрая исправная модель, страхующий запрос при долгом ответе, отключение сбоящих
+text_router = ModelRouter("text", TEXT_MODELS)
+vision_router = ModelRouter("vision", VISION_MODELS)
+# Готовые ответы на точно такие же запросы (переживают перезапуск через снимок на диске)
+response_cache = ResponseCache(path=RESPONSE_CACHE_PATH)
+# Не больше N запросов к модели одновременно (всего и на пользователя), остальные ждут до дедлайна
+admission = AdmissionController()
+# Ключ в обновлении с временем приёма (time.time()), от него считается дедлайн ответа
+RECEIVED_AT = "_received_at"
+BUSY_TEXT = "⏳ Сейчас слишком много запросов, не успеваю ответить. Попробуйте чуть позже."
+
+# === ИСХОДЯЩИЕ ЗАПРОСЫ К TELEGRAM ===
+outbound = OutboundScheduler()
+
+def telegram_send(chat_id, url, priority=PRIORITY_REPLY, **kwargs):
+    """Запрос к Bot API через планировщик: лимиты Telegram, приоритеты и retry_after"""
+    return outbound.call(chat_id, lambda: http_client.post(url, retry_on_429=False, **kwargs), priority=priority)
+
+def telegram_upload(chat_id, url, fields, files, timeout=30):
+    """Загрузка файлов в Bot API: multipart читается с диска кусками, а не собирается в памяти"""
+    body = MultipartBody(fields, files)
+    return telegram_send(chat_id, url, data=body, headers={"Content-Type": body.content_type}, timeout=timeout)
+
+def download_to_cache(cache_key, url, timeout=30, max_bytes=DOWNLOAD_MAX_BYTES):
+    """Скачать картинку кусками прямо в кэш на диске. LocalFile или None.
+    Загрузка обрывается, если файл больше max_bytes или это не картинка"""
+    with http_client.get(url, timeout=timeout, stream=True) as response:
+        if response.status_code != 200:
+            return None
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > max_bytes:
+            logger.warning(f"File too large ({length} bytes): {url[:80]}")
+            return None
+        path = file_cache.put_stream(cache_key, response.iter_content(CHUNK_SIZE), max_bytes=max_bytes,
+                                     validate=is_image)
+    return open_local(path) if path else None
+
+def cached_file(cache_key):
+    path = file_cache.path(cache_key)
+    return open_local(path) if path else None
+
+def open_local(path):
+    """LocalFile держит дескриптор: вытеснение из кэша после этого уже не мешает отправке.
+    None - файл вытеснили раньше, чем его успели открыть"""
+    try:
+        return LocalFile(path)
+    except OSError:
+        return None
 
-def get_file_from_telegram(file_id):
-    """Получить файл от Telegram"""
+def get_file_from_telegram(file_id, file_unique_id=None):
+    """Получить файл от Telegram (один и тот же файл скачивается только раз).
+    Возвращает LocalFile в кэше на диске"""
+    cache_key = f"tg:{file_unique_id}" if file_unique_id else f"tg-id:{file_id}"
+    cached = cached_file(cache_key)
+    if cached is not None:
+        return cached
+    
     # 1. Получаем информацию о файле
-    file_url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getFile"
-    file_info = requests.post(file_url, json={"file_id": file_id}).json()
+    file_url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/getFile"
+    file_info = http_client.post(file_url, json={"file_id": file_id}, timeout=10, idempotent=True).json()
     
     if not file_info.get('ok'):
         return None
     
+    if file_info['result'].get('file_size', 0) > DOWNLOAD_MAX_BYTES:
+        logger.warning(f"Telegram file too large: {file_info['result']['file_size']} bytes")
+        return None
     file_path = file_info['result']['file_path']
     
     # 2. Скачиваем файл
-    download_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}"
-    response = requests.get(download_url)
-    
-    if response.status_code == 200:
-        return response.content
-    return None
+    download_url = f"{TELEGRAM_API_URL}/file/bot{TELEGRAM_TOKEN}/{file_path}"
+    return download_to_cache(cache_key, download_url)
 
-def download_image_from_url(url):
-    """Скачать изображение по URL"""
+def download_image_from_url(url, timeout=10):
+    """Скачать изображение по URL в кэш на диске (LocalFile или None)"""
+    cached = cached_file(f"url:{url}")
+    if cached is not None:
+        return cached
+    
     try:
-        response = requests.get(url, timeout=10)
-        if response.status_code == 200:
-            return response.content
+        return download_to_cache(f"url:{url}", url, timeout=timeout)
     except Exception as e:
         logger.error(f"Error downloading image: {e}")
     return None
 
-def send_photo(chat_id, photo_data, caption=""):
-    """Отправить фото в Telegram"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendPhoto"
-    
-    # Определяем MIME тип
-    mime_type = mimetypes.guess_type("photo.jpg")[0] or "image/jpeg"
+def send_photo(chat_id, photo_data, caption="", source_url=None):
+    """Отправить фото в Telegram.
+    photo_data - байты, LocalFile или file_id уже загруженного фото.
+    Если указан source_url, запоминаем полученный file_id для повторных отправок"""
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/sendPhoto"
     
-    files = {'photo': ('photo.jpg', BytesIO(photo_data), mime_type)}
     data = {'chat_id': chat_id}
-    
     if caption:
-        data['caption'] = caption[:1024]  # Ограничение Telegram
+        data['caption'] = utf16_prefix(caption, 1024)  # Ограничение Telegram
     
     try:
-        response = requests.post(url, files=files, data=data, timeout=30)
+        if isinstance(photo_data, str):
+            # Фото уже есть на серверах Telegram - ничего не загружаем
+            data['photo'] = photo_data
+            response = telegram_send(chat_id, url, data=data, timeout=30)
+        else:
+            # Определяем MIME тип
+            mime_type = mimetypes.guess_type("photo.jpg")[0] or "image/jpeg"
+            response = telegram_upload(chat_id, url, data, {'photo': ('photo.jpg', photo_data, mime_type)})
         if response.status_code == 200:
             logger.info(f"Photo sent successfully to {chat_id}")
+            if source_url:
+                file_ids.put(source_url, response.json()['result']['photo'][-1]['file_id'])
             return True
         else:
             logger.error(f"Error sending photo: {response.status_code} - {response.text}")
@@ -82,177 +195,269 @@ def send_photo(chat_id, photo_data, caption=""):
         logger.error(f"Error sending photo: {e}")
         return False
 
+def send_media_group(chat_id, photos, source_urls=None):
+    """Отправить несколько фото одним альбомом.
+    photos - список (байты, LocalFile или file_id, подпись), source_urls - URL для запоминания file_id"""
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/sendMediaGroup"
+    
+    media = []
+    files = {}
+    for i, (photo_data, caption) in enumerate(photos):
+        if isinstance(photo_data, str):
+            item = {"type": "photo", "media": photo_data}
+        else:
+            name = f"photo{i}"
+            item = {"type": "photo", "media": f"attach://{name}"}
+            files[name] = (f"{name}.jpg", photo_data, "image/jpeg")
+        if caption:
+            item["caption"] = utf16_prefix(caption, 1024)
+        media.append(item)
+    
+    try:
+        response = telegram_upload(chat_id, url, {'chat_id': chat_id, 'media': json.dumps(media)}, files, timeout=60)
+        if response.status_code == 200:
+            if source_urls:
+                for source_url, sent in zip(source_urls, response.json()['result']):
+                    file_ids.put(source_url, sent['photo'][-1]['file_id'])
+            return True
+        logger.error(f"Error sending media group: {response.status_code} - {response.text}")
+        return False
+    except Exception as e:
+        logger.error(f"Error sending media group: {e}")
+        return False
+
 def send_document(chat_id, document_data, filename="image.png", caption=""):
-    """Отправить документ (изображение как файл)"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendDocument"
+    """Отправить документ (изображение как файл): байты или LocalFile"""
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/sendDocument"
     
-    files = {'document': (filename, BytesIO(document_data))}
     data = {'chat_id': chat_id}
     
     if caption:
-        data['caption'] = caption[:1024]
+        data['caption'] = utf16_prefix(caption, 1024)
     
     try:
-        response = requests.post(url, files=files, data=data, timeout=30)
+        mime_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        response = telegram_upload(chat_id, url, data, {'document': (filename, document_data, mime_type)})
         return response.status_code == 200
     except Exception as e:
         logger.error(f"Error sending document: {e}")
         return False
 
-def ask_openrouter_with_history(messages):
-    """Запрос к OpenRouter с историей диалога"""
-    url = "https://openrouter.ai/api/v1/chat/completions"
+def read_openrouter_stream(response, on_delta, cancelled=None):
+    """Собрать ответ из SSE-потока OpenRouter, передавая накопленный текст в on_delta.
+    cancelled - Event: поток закрывается, генерация на стороне модели прекращается"""
+    # У text/event-stream может не быть charset, а requests тогда берёт latin-1
+    response.encoding = 'utf-8'
+    text = ""
+    
+    with response:
+        for line in response.iter_lines(decode_unicode=True):
+            if cancelled is not None and cancelled.is_set():
+                return None
+            # Пропускаем пустые строки и комментарии вида ": OPENROUTER PROCESSING"
+            if not line or not line.startswith('data:'):
+                continue
+            
+            payload = line[5:].strip()
+            if payload == '[DONE]':
+                break
+            
+            chunk = json.loads(payload)
+            if 'error' in chunk:
+                logger.error(f"OpenRouter stream error: {chunk['error']}")
+                return None
+            # usage приходит в последнем куске
+            metrics.record_usage(chunk.get('usage'))
+            
+            choices = chunk.get('choices') or []
+            delta = choices[0].get('delta', {}).get('content') if choices else None
+            if delta:
+                text += delta
+                on_delta(text)
+    
+    return text or None
+
+def openrouter_attempt(data, model, attempt, on_delta=None, images=None):
+    """Одна попытка запроса к OpenRouter для модели, выбранной роутером.
+    images - картинки для меток image_placeholder() в data, кодируются в base64 при отправке"""
+    url = OPENROUTER_URL
     
     headers = {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
         "Content-Type": "application/json"
     }
     
-    data = {
-        "model": MODEL,
-        "messages": messages,
-        "max_tokens": 1500  # Увеличили для ответов с URL изображений
-    }
-    
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=60)
+        # Сообщения истории сериализуются один раз и склеиваются в одинаковый префикс
+        payload = serialize_request(model, data)
+        body = DataUrlJSONBody(payload, images) if images else payload.encode("utf-8")
+        response = http_client.post(url, headers=headers, data=body, timeout=attempt.timeout(60), idempotent=True,
+                                    stream=on_delta is not None)
         
         if response.status_code == 200:
+            if on_delta:
+                # Куски показываем, только если эта попытка опередила страхующую
+                return read_openrouter_stream(response, lambda text: attempt.claim() and on_delta(text),
+                                              cancelled=attempt.cancelled)
             result = response.json()
+            metrics.record_usage(result.get('usage'))
             return result['choices'][0]['message']['content']
         else:
-            logger.error(f"OpenRouter error: {response.status_code} - {response.text}")
+            logger.error(f"OpenRouter error ({model}): {response.status_code} - {response.text}")
             return None
             
     except Exception as e:
-        logger.error(f"Request error: {e}")
+        logger.error(f"Request error ({model}): {e}")
         return None
 
-def ask_openrouter_with_image(prompt, image_bytes=None, image_url=None, history=None):
-    """Запрос к OpenRouter с изображением и историей"""
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json"
+def ask_openrouter_with_history(messages, on_delta=None, max_tokens=1500, deadline=None, slot=None):
+    """Запрос к OpenRouter с историей диалога.
+    Если передан on_delta - ответ читается потоком и отдаётся в on_delta по мере генерации.
+    deadline (time.time()) - после него запрос отменяется.
+    slot - слот допуска: освобождается, когда закончатся все попытки, включая страхующие"""
+    data = {
+        "messages": messages,
+        "max_tokens": max_tokens,  # 1500 по умолчанию - для ответов с URL изображений
+        "usage": {"include": True}  # В usage придут и закэшированные токены
     }
+    if on_delta:
+        data["stream"] = True
     
-    # Формируем сообщения с историей
-    messages = [
-        {
-            "role": "system", 
-            "content": """Ты полезный ассистент. Отвечай на русском языке. Помни историю диалога.
-
-Если пользователь просит картинку, изображение, фото, рисунок или что-то визуальное:
-1. Ты МОЖЕШЬ генерировать/создавать изображения
-2. Для этого используй специальный формат:
-   [IMAGE:URL_ЗДЕСЬ]
-   Например: [IMAGE:https://example.com/image.jpg]
-3. Можешь добавить описание после URL, разделяя вертикальной чертой: [IMAGE:https://example.com/image.jpg|Описание изображения]
-4. Если не можешь или не нужно генерировать изображение - просто ответь текстом."""
-        }
-    ]
-    
-    # Добавляем историю диалога если есть
-    if history:
-        for msg in history:
-            messages.append(msg)
+    return text_router.call(lambda model, attempt: openrouter_attempt(data, model, attempt, on_delta),
+                            streaming=on_delta is not None, deadline=deadline,
+                            on_settled=admission.hold(slot) if slot else None)
+
+def ask_openrouter_with_image(prompt, image_bytes=None, image_url=None, history=None, image_mime="image/jpeg",
+                              images=None, deadline=None, slot=None):
+    """Запрос к OpenRouter с изображением и историей.
+    images - список (байты, mime) для нескольких фото в одном сообщении, slot - как в ask_openrouter_with_history"""
+    if images is None and image_bytes:
+        images = [(image_bytes, image_mime)]
     
-    # Если есть изображение
-    if image_bytes:
-        # Конвертируем в base64
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-        
-        messages.append({
-            "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    "text": prompt if prompt else "Что на этом изображении?"
-                },
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{image_base64}"
-                    }
+    # Если есть изображения - все в одном сообщении списком image_url
+    if images:
+        content = [{
+            "type": "text",
+            "text": prompt if prompt else "Что на этом изображении?"
+        }]
+        # Вместо data: URL - метки, base64 пишется кусками прямо в тело запроса
+        for i in range(len(images)):
+            content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": image_placeholder(i)
                 }
-            ]
-        })
+            })
     elif image_url:
-        messages.append({
-            "role": "user",
-            "content": [
-                {
-                    "type": "text", 
-                    "text": prompt if prompt else "Что на этом изображении?"
-                },
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": image_url
-                    }
+        content = [
+            {
+                "type": "text", 
+                "text": prompt if prompt else "Что на этом изображении?"
+            },
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": image_url
                 }
-            ]
-        })
+            }
+        ]
     else:
         # Только текст
-        messages.append({
-            "role": "user",
-            "content": prompt
-        })
+        content = prompt
+    
+    # Системный промпт и история - общий неизменный префикс
+    messages = build_messages(history or [], content)
     
     data = {
-        "model": MODEL,
         "messages": messages,
-        "max_tokens": 1500
+        "max_tokens": 1500,
+        "usage": {"include": True}
     }
     
-    try:
-        response = requests.post(url, headers=headers, json=data, timeout=60)
-        
-        if response.status_code == 200:
-            result = response.json()
-            return result['choices'][0]['message']['content']
-        else:
-            logger.error(f"OpenRouter error: {response.status_code} - {response.text}")
-            return None
-            
-    except Exception as e:
-        logger.error(f"Request error: {e}")
-        return None
+    return vision_router.call(lambda model, attempt: openrouter_attempt(data, model, attempt, images=images),
+                              deadline=deadline, on_settled=admission.hold(slot) if slot else None)
 
 def send_message(chat_id, text, parse_mode="Markdown"):
-    """Отправка сообщения"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+    """
+    Отправка сообщения. Markdown переводится в HTML заранее, длинный текст
+    режется на части, части уходят по порядку одна за другой
+    """
+    return deliver_text(text, chat_sender(chat_id), parse_mode, on_fallback=metrics.formatting_fallbacks.inc)
+
+def send_chunks(chat_id, chunks):
+    """Части из render_chunks [(исходный текст, HTML или None)]. Без HTML или если Telegram
+    его не принял - исходный текст уходит совсем без разметки"""
+    return deliver_chunks(chunks, chat_sender(chat_id), on_fallback=metrics.formatting_fallbacks.inc)
+
+def chat_sender(chat_id):
+    """send(текст, parse_mode) -> bool для частей ответа в чат"""
+    return lambda text, parse_mode: send_message_with_id(chat_id, text, parse_mode) is not None
+
+def send_message_with_id(chat_id, text, parse_mode="Markdown"):
+    """Отправка сообщения, возвращает message_id или None"""
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/sendMessage"
     data = {
         "chat_id": chat_id, 
         "text": text,
-        "parse_mode": parse_mode
     }
+    if parse_mode:
+        data["parse_mode"] = parse_mode
     
     try:
-        response = requests.post(url, json=data, timeout=10)
-        return response.status_code == 200
+        response = telegram_send(chat_id, url, json=data, timeout=10)
+        if response.status_code == 200:
+            return response.json()['result']['message_id']
+        logger.error(f"Send error: {response.status_code} - {response.text}")
     except Exception as e:
         logger.error(f"Send error: {e}")
+    return None
+
+def edit_message_text(chat_id, message_id, text, parse_mode=None, priority=PRIORITY_REPLY):
+    """Изменить текст уже отправленного сообщения"""
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/editMessageText"
+    data = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "text": text
+    }
+    if parse_mode:
+        data["parse_mode"] = parse_mode
+    
+    try:
+        response = telegram_send(chat_id, url, priority=priority, json=data, timeout=10)
+        if response.status_code == 200:
+            return True
+        # Текст не изменился - это не ошибка
+        if 'message is not modified' in response.text:
+            return True
+        logger.error(f"Edit error: {response.status_code} - {response.text}")
+        return False
+    except Exception as e:
+        logger.error(f"Edit error: {e}")
+        return False
+
+def delete_message(chat_id, message_id):
+    """Удалить сообщение"""
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/deleteMessage"
+    try:
+        response = telegram_send(chat_id, url, json={"chat_id": chat_id, "message_id": message_id}, timeout=10)
+        return response.status_code == 200
+    except Exception as e:
+        logger.error(f"Delete error: {e}")
         return False
 
 def send_chat_action(chat_id, action="typing"):
     """Отправка действия (typing, upload_photo, upload_document)"""
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendChatAction"
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/sendChatAction"
     data = {"chat_id": chat_id, "action": action}
     
-    try:
-        requests.post(url, json=data, timeout=5)
-    except:
-        pass
+    # Статус не ждём: планировщик отправит его, если успеет, и выбросит устаревший
+    outbound.submit_action(chat_id, lambda: http_client.post(url, json=data, timeout=5, idempotent=True,
+                                                             retry_on_429=False))
 
 def extract_image_urls_from_response(text):
     """Извлечь URL изображений из ответа AI"""
-    import re
-    # Паттерн для поиска [IMAGE:URL|описание] или [IMAGE:URL]
-    pattern = r'\[IMAGE:(https?://[^\s\|\[\]]+)(?:\|([^\]]+))?\]'
-    matches = re.findall(pattern, text)
+    matches = IMAGE_TAG_PATTERN.findall(text)
     
     image_data = []
     for url, description in matches:
@@ -262,28 +467,394 @@ def extract_image_urls_from_response(text):
         })
     
     # Убираем теги из текста
-    clean_text = re.sub(pattern, '', text).strip()
+    clean_text = IMAGE_TAG_PATTERN.sub('', text).strip()
     
     return clean_text, image_data
 
+def download_images(images, deadline=IMAGE_FETCH_DEADLINE):
+    """Скачать картинки параллельно с общим дедлайном. Возвращает [(img, данные или None)]"""
+    futures = [media_executor.submit(download_image_from_url, img['url'], deadline) for img in images]
+    with metrics.span("image_download"):
+        done, not_done = wait(futures, timeout=deadline)
+    for future in not_done:
+        future.cancel()
+    return [(img, future.result() if future in done else None) for img, future in zip(images, futures)]
+
+def send_reply_images(chat_id, images):
+    """Отправить картинки из ответа AI: альбомом, если получится, иначе по одной"""
+    send_chat_action(chat_id, "upload_photo")
+    
+    images = images[:MAX_IMAGES_PER_REPLY]
+    
+    # Уже отправленные картинки повторно шлём по file_id, остальные скачиваем
+    photos = {img['url']: file_ids.get(img['url']) for img in images}
+    for img, img_data in download_images([img for img in images if not photos[img['url']]]):
+        photos[img['url']] = img_data
+    
+    loaded = []
+    for img in images:
+        if photos[img['url']]:
+            loaded.append((img, photos[img['url']]))
+        else:
+            send_message(chat_id, f"⚠️ Не удалось загрузить изображение: {img['description']}")
+    
+    # В альбоме должно быть от 2 до 10 элементов
+    if len(loaded) > 1 and send_media_group(chat_id, [(photo, img['description']) for img, photo in loaded],
+                                            source_urls=[img['url'] for img, _ in loaded]):
+        return
+    
+    for img, photo in loaded:
+        if send_photo(chat_id, photo, img['description'], source_url=img['url']):
+            continue
+        if isinstance(photo, str):
+            # file_id устарел - забываем его и загружаем файл заново
+            file_ids.forget(img['url'])
+            photo = download_image_from_url(img['url'])
+            if photo and send_photo(chat_id, photo, img['description'], source_url=img['url']):
+                continue
+        if photo:
+            # Пробуем отправить как документ
+            send_document(chat_id, photo, "image.jpg", img['description'])
+
+def send_reply(chat_id, text, images):
+    """Текст и картинки ответа отправляются параллельно"""
+    text_job = media_executor.submit(send_message, chat_id, text) if text else None
+    if images:
+        send_reply_images(chat_id, images)
+    if text_job:
+        text_job.result()
+
+class StreamingReply:
+    """Сообщение-заглушка, которое дописывается по мере генерации ответа"""
+    
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.message_id = send_message_with_id(chat_id, "⏳", parse_mode=None)
+        self._last_edit = 0
+        self._shown = ""
+        # Промежуточная правка идёт в фоне; после finish() она уже не должна отправляться
+        self._edit_lock = threading.Lock()
+        self._finished = False
+    
+    def update(self, text):
+        """Показать промежуточный текст (не чаще STREAM_EDIT_INTERVAL)"""
+        if self.message_id is None:
+            return
+        now = time.monotonic()
+        if now - self._last_edit < STREAM_EDIT_INTERVAL:
+            return
+        
+        # Готовые теги [IMAGE:] убираем, недописанный тег не показываем
+        visible = IMAGE_TAG_PATTERN.sub('', text)
+        if '[IMAGE' in visible:
+            visible = visible[:visible.rindex('[IMAGE')]
+        visible = utf16_prefix(visible.strip(), TELEGRAM_TEXT_LIMIT - 2)
+        if not visible or visible == self._shown:
+            return
+        
+        # Правку не ждём: поток чтения ответа не должен стоять в лимите чата (в группе ~3 с на правку).
+        # Пока правка ждёт очереди, более свежая её заменяет
+        outbound.submit_latest(self.chat_id, lambda: self._edit_progress(visible), PRIORITY_EDIT)
+        self._shown = visible
+        self._last_edit = now
+    
+    def _edit_progress(self, visible):
+        """Промежуточная правка из планировщика. Пока ответ не готов, Markdown может быть незакрыт -
+        правим без разметки"""
+        with self._edit_lock:
+            if self._finished:
+                return None
+            url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/editMessageText"
+            return http_client.post(url, json={"chat_id": self.chat_id, "message_id": self.message_id,
+                                               "text": visible + " ▌"}, timeout=10, retry_on_429=False)
+    
+    def finish(self, text):
+        """Финальная версия сообщения с разметкой"""
+        # Ждём правку, которая уже отправляется, а ждущую в очереди отменяем
+        with self._edit_lock:
+            self._finished = True
+        outbound.cancel_latest(self.chat_id, PRIORITY_EDIT)
+        if self.message_id is None:
+            if text:
+                send_message(self.chat_id, text)
+            return
+        if not text:
+            delete_message(self.chat_id, self.message_id)
+            return
+        
+        # Первая часть заменяет заглушку, остальные досылаются следом
+        chunks = render_chunks(text)
+        if not chunks:
+            delete_message(self.chat_id, self.message_id)
+            return
+        plain, formatted = chunks[0]
+        if formatted is None or not edit_message_text(self.chat_id, self.message_id, formatted, parse_mode="HTML"):
+            if formatted is not None:
+                metrics.formatting_fallbacks.inc()
+            edit_message_text(self.chat_id, self.message_id, plain)
+        send_chunks(self.chat_id, chunks[1:])
+
+# === КРАТКОЕ СОДЕРЖАНИЕ ИСТОРИИ ===
+SUMMARY_PROMPT = (
+    "Ты ведёшь краткое содержание диалога пользователя с ассистентом. "
+    "Обнови текущее краткое содержание с учётом новых сообщений. "
+    "Сохрани факты о пользователе, его просьбы и договорённости, опусти детали. "
+    f"Пиши по-русски, не длиннее {SUMMARY_MAX_TOKENS} токенов. Выведи только новое краткое содержание."
+)
+
+def fold_into_summary(history_id, dropped):
+    """Дописать выпавшие из окна истории сообщения в краткое содержание (выполняется в фоне)"""
+    previous = history_store.summary(history_id)
+    dialog = "\n".join(f"{m['role']}: {m['content']}" for m in dropped)
+    
+    # Общий лимит запросов к модели, но пользователи идут вперёд
+    with admission.slot(history_id, background=True) as slot:
+        summary = ask_openrouter_with_history(build_messages(
+            [], f"Текущее краткое содержание:\n{previous or '(пусто)'}\n\nНовые сообщения:\n{dialog}",
+            system_prompt=SUMMARY_PROMPT
+        ), max_tokens=SUMMARY_MAX_TOKENS * 2, slot=slot)
+    
+    if not summary:
+        # Без модели просто дописываем сообщения и оставляем самое свежее
+        summary = f"{previous or ''}\n{dialog}".strip()
+        limit = SUMMARY_MAX_TOKENS * 3  # ~3 символа на токен
+        if len(summary) > limit:
+            summary = "…" + summary[-limit:]
+    
+    history_store.set_summary(history_id, summary.strip(), expected=previous)
+
+# Сворачиваем по очереди для каждого пользователя, чтобы не потерять обновления
+summary_dispatcher = ChatDispatcher(lambda job: fold_into_summary(*job), workers=2)
+
+history_store = create_history_store(
+    max_messages=HISTORY_MAX_MESSAGES,
+    token_budget=HISTORY_TOKEN_BUDGET,
+    on_evict=lambda history_id, dropped: summary_dispatcher.submit(history_id, (history_id, dropped))
+)
+
 @app.route('/')
 def home():
     return """
     <h1>🤖 Бот с поддержкой фото и памятью диалога</h1>
     <p>Можно отправлять фото и текст! Бот тоже может отправлять фото.</p>
-    <p>Бот запоминает историю разговора (последние 5 пар вопрос-ответ)</p>
+    <p>Бот запоминает историю разговора (свежие сообщения + краткое содержание более ранних)</p>
     <p>Модель: openai/gpt-5.1-codex-mini</p>
     <p>🎨 Бот может отправлять изображения по запросу!</p>
     """
 
-@app.route('/webhook', methods=['POST'])
-def webhook():
-    """Обработчик сообщений с фото и памятью диалога"""
-    data = request.json
+def fetch_photo(photo_sizes):
+    """Скачать фото из Telegram и подготовить для модели: (байты или LocalFile, mime) или None"""
+    # Берем самый маленький размер, которого хватит модели
+    photo = choose_photo_size(photo_sizes)
+    with metrics.span("get_file"):
+        image_data = get_file_from_telegram(photo['file_id'], photo.get('file_unique_id'))
+    if not image_data:
+        return None
+    # Уменьшаем и перекодируем перед отправкой модели
+    with metrics.span("prepare_image"):
+        return prepare_image(image_data)
+
+def answer_photos(chat_id, user_id, caption, photos, use_cache=True, deadline=None):
+    """Ответ на одно фото или альбом: все картинки уходят модели одним запросом.
+    use_cache=False - всегда спрашивать модель, deadline - позже ответ не нужен"""
+    send_chat_action(chat_id, "typing")
     
-    if not data:
-        return jsonify({"error": "No data"}), 400
+    # Берем историю диалога (без учета system сообщения)
+    history_id = history_key(chat_id, user_id)
+    history = history_store.window(history_id, HISTORY_TOKEN_BUDGET + SUMMARY_MAX_TOKENS)
+    
+    if caption:
+        user_message = caption
+    else:
+        user_message = "Что на этом изображении?" if len(photos) == 1 else "Что на этих изображениях?"
     
+    # Скачиваем фото (альбом - параллельно)
+    if len(photos) == 1:
+        images = [fetch_photo(photos[0])]
+    else:
+        images = list(media_executor.map(fetch_photo, photos))
+    images = [image for image in images if image]
+    
+    if images:
+        send_message(chat_id, "🤔 Анализирую изображение..." if len(images) == 1 else "🤔 Анализирую изображения...")
+        
+        # Тот же вопрос к тем же фото - ответ из кэша
+        cache_key = None
+        if use_cache:
+            cache_key = response_cache.key(VISION_MODELS, history + [{"role": "user", "content": user_message}],
+                                           1500, image_hashes=[source_digest(source) for source, _ in images])
+        result = response_cache.get(cache_key) if cache_key else None
+        
+        if result is None:
+            # Запрос к AI с фото и историей
+            try:
+                with admission.slot(user_id, deadline) as slot, metrics.span("llm"):
+                    answer = ask_openrouter_with_image(
+                        prompt=user_message, 
+                        images=images,
+                        history=history,
+                        deadline=deadline,
+                        slot=slot
+                    )
+            except Overloaded as e:
+                notify_busy(chat_id, e.reason)
+                return
+            if answer:
+                # Проверяем, содержит ли ответ URL изображения
+                result = (answer,) + extract_image_urls_from_response(answer)
+                if cache_key:
+                    response_cache.put(cache_key, result)
+        
+        if result:
+            _, clean_text, image_urls = result
+            
+            # Отправляем изображения и текстовую часть если есть
+            send_reply(chat_id, clean_text, image_urls)
+            
+            # Сохраняем вопрос и ответ в историю (без тегов изображений)
+            history_store.append(history_id, {
+                "role": "user", 
+                "content": user_message + (" [ФОТО]" if len(images) == 1 else f" [ФОТО x{len(images)}]")
+            }, {
+                "role": "assistant", 
+                "content": clean_text or f"Отправил {len(image_urls)} изображение(й)"
+            })
+            
+        else:
+            send_message(chat_id, "⚠️ Не удалось проанализировать фото.")
+    else:
+        send_message(chat_id, "❌ Не удалось загрузить фото.")
+
+def answer_text(chat_id, user_id, text, use_cache=True, deadline=None):
+    """Ответ на текст с учётом истории. use_cache=False - всегда спрашивать модель,
+    deadline - позже ответ не нужен"""
+    send_chat_action(chat_id, "typing")
+    
+    # Получаем историю диалога
+    history_id = history_key(chat_id, user_id)
+    history = history_store.window(history_id, HISTORY_TOKEN_BUDGET + SUMMARY_MAX_TOKENS)
+    
+    # Формируем сообщения для AI: системный промпт, история и текущее сообщение
+    messages = build_messages(history, text)
+    
+    # Такой же запрос уже был - отвечаем из кэша сразу, без заглушки
+    cache_key = response_cache.key(TEXT_MODELS, messages, 1500) if use_cache else None
+    result = response_cache.get(cache_key) if cache_key else None
+    reply = None
+    
+    if result is None:
+        # Запрос к AI с историей (в режиме стриминга ответ сразу пишется в заглушку)
+        try:
+            with admission.slot(user_id, deadline) as slot:
+                reply = StreamingReply(chat_id) if STREAM_RESPONSES else None
+                with metrics.span("llm_stream" if reply else "llm"):
+                    answer = ask_openrouter_with_history(messages, on_delta=reply.update if reply else None,
+                                                         deadline=deadline, slot=slot)
+        except Overloaded as e:
+            notify_busy(chat_id, e.reason)
+            return
+        if answer:
+            # Проверяем, содержит ли ответ URL изображения
+            result = (answer,) + extract_image_urls_from_response(answer)
+            if cache_key:
+                response_cache.put(cache_key, result)
+    
+    if result:
+        answer, clean_text, image_urls = result
+        
+        # Заглушка получает финальный текст, картинки идут следом
+        if reply:
+            reply.finish(clean_text or ("" if image_urls else answer))
+        
+        # Отправляем изображения и текст (при стриминге текст уже в заглушке).
+        # Если нет ни текста, ни изображений, отправляем оригинальный ответ
+        if reply:
+            if image_urls:
+                send_reply_images(chat_id, image_urls)
+        else:
+            send_reply(chat_id, clean_text or ("" if image_urls else answer), image_urls)
+        
+        # Сохраняем в историю
+        history_store.append(history_id, {"role": "user", "content": text}, {
+            "role": "assistant", 
+            "content": clean_text or f"Отправил {len(image_urls)} изображение(й)" if image_urls else answer
+        })
+        
+    elif reply:
+        reply.finish("⚠️ Ошибка. Попробуйте позже.")
+    else:
+        send_message(chat_id, "⚠️ Ошибка. Попробуйте позже.")
+
+# === ОТВЕТЫ НА КОМАНДЫ ===
+# Текст не меняется: разметка переводится в HTML и проверяется один раз при запуске
+START_TEXT = (
+    "Я бот с AI который понимает фото и запоминает разговор!\n\n"
+    "📸 **Что умею:**\n"
+    "• Отвечать на текстовые сообщения\n"
+    "• Анализировать фотографии\n"
+    "• Отправлять изображения по запросу\n"
+    "• Помнить историю нашего диалога\n\n"
+    "🎨 **Как получить изображение:**\n"
+    "Просто попроси меня нарисовать что-то! Например:\n"
+    "• \"Нарисуй кота\"\n"
+    "• \"Покажи фото заката\"\n"
+    "• \"Сгенерируй изображение города будущего\"\n\n"
+    "🔄 **Команды:**\n"
+    "/clear - очистить историю разговора\n"
+    "/help - справка\n"
+    "/image - примеры запросов для изображений\n\n"
+    "💾 Память: помню свежую часть разговора, а более раннее - в кратком виде.")
+
+HELP_TEXT = (
+    "📸 **Что умеет бот:**\n"
+    "1. Отправь фото - опишу что на нём\n"
+    "2. Отправь фото с текстом - отвечу по контексту\n"
+    "3. Просто текст - обычный ответ с учётом истории\n"
+    "4. Попроси изображение - постараюсь отправить картинку\n\n"
+    "🔄 **Команды:**\n"
+    "/start - начать заново\n"
+    "/clear - очистить историю\n"
+    "/help - эта справка\n"
+    "/image - примеры запросов для изображений\n\n"
+    "💾 **Память:** бот помнит свежие сообщения и краткое содержание более ранних\n\n"
+    "📋 **Примеры:**\n"
+    "• Фото еды → 'Это пицца с грибами'\n"
+    "• 'Нарисуй кота' → картинка кота\n"
+    "• 'Привет' → 'Привет!' с памятью диалога")
+
+IMAGE_TEXT = (
+    "🎨 **Примеры запросов для изображений:**\n\n"
+    "🖼️ **Животные:**\n"
+    "• Нарисуй милого кота\n"
+    "• Покажи фото собаки породы хаски\n"
+    "• Сгенерируй изображение панды\n\n"
+    "🌄 **Природа:**\n"
+    "• Покажи красивый закат\n"
+    "• Нарисуй горный пейзаж\n"
+    "• Фото тропического пляжа\n\n"
+    "🏙️ **Города:**\n"
+    "• Изображение Нью-Йорка\n"
+    "• Нарисуй старый европейский город\n"
+    "• Город будущего\n\n"
+    "🎨 **Искусство:**\n"
+    "• Картина в стиле Ван Гога\n"
+    "• Абстрактное искусство\n"
+    "• Мандала для медитации\n\n"
+    "📝 **Просто попроси, и я постараюсь!**")
+
+START_REPLY = render_chunks(START_TEXT)
+HELP_REPLY = render_chunks(HELP_TEXT)
+IMAGE_REPLY = render_chunks(IMAGE_TEXT)
+CLEAR_REPLY = render_chunks("🗑️ История диалога очищена! Начинаем новый разговор.")
+
+def start_reply(name):
+    """Приветствие с именем перед готовым текстом /start (имя экранируется, а не размечается)"""
+    greeting = f"🤖 Привет, {name}!\n"
+    plain, formatted = START_REPLY[0]
+    return [(greeting + plain, html.escape(greeting, quote=False) + formatted if formatted else None)]
+
+def handle_update(data, deadline=None):
+    """Обработчик сообщений с фото и памятью диалога (выполняется в воркере)"""
     if 'message' in data:
         message = data['message']
         chat_id = message['chat']['id']
@@ -292,235 +863,309 @@ def webhook():
         
         # Команда /start
         if text == '/start':
-            conversation_history[user_id] = []  # Очищаем историю
+            history_store.clear(history_key(chat_id, user_id))  # Очищаем историю
             name = message['from'].get('first_name', 'друг')
-            send_message(chat_id, 
-                f"🤖 Привет, {name}!\n"
-                f"Я бот с AI который понимает фото и запоминает разговор!\n\n"
-                f"📸 **Что умею:**\n"
-                f"• Отвечать на текстовые сообщения\n"
-                f"• Анализировать фотографии\n"
-                f"• Отправлять изображения по запросу\n"
-                f"• Помнить историю нашего диалога\n\n"
-                f"🎨 **Как получить изображение:**\n"
-                f"Просто попроси меня нарисовать что-то! Например:\n"
-                f"• \"Нарисуй кота\"\n"
-                f"• \"Покажи фото заката\"\n"
-                f"• \"Сгенерируй изображение города будущего\"\n\n"
-                f"🔄 **Команды:**\n"
-                f"/clear - очистить историю разговора\n"
-                f"/help - справка\n"
-                f"/image - примеры запросов для изображений\n\n"
-                f"💾 Память: сохраняю последние {MAX_HISTORY//2} пар вопрос-ответ.")
+            send_chunks(chat_id, start_reply(name))
         
         # Команда /clear
         elif text == '/clear':
-            conversation_history[user_id] = []
-            send_message(chat_id, "🗑️ История диалога очищена! Начинаем новый разговор.")
+            history_store.clear(history_key(chat_id, user_id))
+            send_chunks(chat_id, CLEAR_REPLY)
         
         # Команда /help
         elif text == '/help':
-            send_message(chat_id,
-                "📸 **Что умеет бот:**\n"
-                "1. Отправь фото - опишу что на нём\n"
-                "2. Отправь фото с текстом - отвечу по контексту\n"
-                "3. Просто текст - обычный ответ с учётом истории\n"
-                "4. Попроси изображение - постараюсь отправить картинку\n\n"
-                "🔄 **Команды:**\n"
-                "/start - начать заново\n"
-                "/clear - очистить историю\n"
-                "/help - эта справка\n"
-                "/image - примеры запросов для изображений\n\n"
-                "💾 **Память:** бот помнит последние " + str(MAX_HISTORY//2) + " пар вопрос-ответ\n\n"
-                "📋 **Примеры:**\n"
-                "• Фото еды → 'Это пицца с грибами'\n"
-                "• 'Нарисуй кота' → картинка кота\n"
-                "• 'Привет' → 'Привет!' с памятью диалога")
+            send_chunks(chat_id, HELP_REPLY)
         
         # Команда /image
         elif text == '/image':
-            send_message(chat_id,
-                "🎨 **Примеры запросов для изображений:**\n\n"
-                "🖼️ **Животные:**\n"
-                "• Нарисуй милого кота\n"
-                "• Покажи фото собаки породы хаски\n"
-                "• Сгенерируй изображение панды\n\n"
-                "🌄 **Природа:**\n"
-                "• Покажи красивый закат\n"
-                "• Нарисуй горный пейзаж\n"
-                "• Фото тропического пляжа\n\n"
-                "🏙️ **Города:**\n"
-                "• Изображение Нью-Йорка\n"
-                "• Нарисуй старый европейский город\n"
-                "• Город будущего\n\n"
-                "🎨 **Искусство:**\n"
-                "• Картина в стиле Ван Гога\n"
-                "• Абстрактное искусство\n"
-                "• Мандала для медитации\n\n"
-                "📝 **Просто попроси, и я постараюсь!**")
+            send_chunks(chat_id, IMAGE_REPLY)
         
         # Если есть фото
         elif 'photo' in message:
-            send_chat_action(chat_id, "typing")
-            
-            # Берем историю диалога (без учета system сообщения)
-            history = conversation_history[user_id][-MAX_HISTORY:] if user_id in conversation_history else []
-            
-            # Берем самое большое фото
-            photos = message['photo']
-            largest_photo = photos[-1]  # Последнее - самое большое
-            file_id = largest_photo['file_id']
-            
-            caption = message.get('caption', '')
-            user_message = caption if caption else "Что на этом изображении?"
-            
-            # Скачиваем фото
-            image_data = get_file_from_telegram(file_id)
-            
-            if image_data:
-                send_message(chat_id, "🤔 Анализирую изображение...")
-                
-                # Запрос к AI с фото и историей
-                answer = ask_openrouter_with_image(
-                    prompt=user_message, 
-                    image_bytes=image_data,
-                    history=history
-                )
-                
-                if answer:
-                    # Проверяем, содержит ли ответ URL изображения
-                    clean_text, image_urls = extract_image_urls_from_response(answer)
-                    
-                    # Сохраняем в историю (без тегов изображений)
-                    conversation_history[user_id].append({
-                        "role": "user", 
-                        "content": user_message + " [ФОТО]"
-                    })
-                    
-                    # Отправляем изображения если есть
-                    if image_urls:
-                        send_chat_action(chat_id, "upload_photo")
-                        for img in image_urls[:3]:  # Максимум 3 изображения за раз
-                            img_data = download_image_from_url(img['url'])
-                            if img_data:
-                                send_photo(chat_id, img_data, img['description'])
-                            else:
-                                send_message(chat_id, f"⚠️ Не удалось загрузить изображение: {img['description']}")
-                    
-                    # Отправляем текстовую часть если есть
-                    if clean_text:
-                        send_message(chat_id, clean_text)
-                    
-                    # Сохраняем ответ в историю (без тегов)
-                    conversation_history[user_id].append({
-                        "role": "assistant", 
-                        "content": clean_text or f"Отправил {len(image_urls)} изображение(й)"
-                    })
-                    
-                    # Ограничиваем размер истории
-                    if len(conversation_history[user_id]) > MAX_HISTORY * 2:
-                        conversation_history[user_id] = conversation_history[user_id][-MAX_HISTORY*2:]
-                    
-                else:
-                    send_message(chat_id, "⚠️ Не удалось проанализировать фото.")
-            else:
-                send_message(chat_id, "❌ Не удалось загрузить фото.")
+            answer_photos(chat_id, user_id, message.get('caption', ''), [message['photo']], deadline=deadline)
         
         # Только текст (не команда)
         elif text.strip() and not text.startswith('/'):
-            send_chat_action(chat_id, "typing")
-            
-            # Получаем историю диалога
-            history = conversation_history[user_id][-MAX_HISTORY:] if user_id in conversation_history else []
-            
-            # Формируем сообщения для AI
-            messages = [
-                {
-                    "role": "system", 
-                    "content": """Ты полезный ассистент. Отвечай на русском языке. Помни историю диалога.
-
-Если пользователь просит картинку, изображение, фото, рисунок или что-то визуальное:
-1. Ты МОЖЕШЬ генерировать/создавать изображения
-2. Для этого используй специальный формат:
-   [IMAGE:URL_ЗДЕСЬ]
-   Например: [IMAGE:https://example.com/image.jpg]
-3. Можешь добавить описание после URL, разделяя вертикальной чертой: [IMAGE:https://example.com/image.jpg|Описание изображения]
-4. Если не можешь или не нужно генерировать изображение - просто ответь текстом."""
-                }
-            ]
-            
-            # Добавляем историю
-            for msg in history:
-                messages.append(msg)
-            
-            # Добавляем текущее сообщение
-            messages.append({"role": "user", "content": text})
-            
-            # Запрос к AI с историей
-            answer = ask_openrouter_with_history(messages)
-            
-            if answer:
-                # Проверяем, содержит ли ответ URL изображения
-                clean_text, image_urls = extract_image_urls_from_response(answer)
-                
-                # Отправляем изображения если есть
-                if image_urls:
-                    send_chat_action(chat_id, "upload_photo")
-                    for img in image_urls[:3]:  # Максимум 3 изображения за раз
-                        img_data = download_image_from_url(img['url'])
-                        if img_data:
-                            success = send_photo(chat_id, img_data, img['description'])
-                            if not success:
-                                # Пробуем отправить как документ
-                                send_document(chat_id, img_data, "image.jpg", img['description'])
-                        else:
-                            send_message(chat_id, f"⚠️ Не удалось загрузить изображение: {img['description']}")
-                
-                # Отправляем текстовую часть если есть
-                if clean_text:
-                    send_message(chat_id, clean_text)
-                elif not image_urls:
-                    # Если нет ни текста, ни изображений, отправляем оригинальный ответ
-                    send_message(chat_id, answer)
-                
-                # Сохраняем в историю
-                conversation_history[user_id].append({"role": "user", "content": text})
-                conversation_history[user_id].append({
-                    "role": "assistant", 
-                    "content": clean_text or f"Отправил {len(image_urls)} изображение(й)" if image_urls else answer
-                })
-                
-                # Ограничиваем размер истории
-                if len(conversation_history[user_id]) > MAX_HISTORY * 2:
-                    conversation_history[user_id] = conversation_history[user_id][-MAX_HISTORY*2:]
-                
-            else:
-                send_message(chat_id, "⚠️ Ошибка. Попробуйте позже.")
+            answer_text(chat_id, user_id, text, deadline=deadline)
+
+def update_kind(message):
+    text = message.get('text', '')
+    return 'photo' if 'photo' in message else 'command' if text.startswith('/') else 'text'
+
+def coalesce_key(job):
+    """Ключ склейки: фото одного альбома или тексты одного отправителя подряд. Команды идут отдельно"""
+    return message_group_key(job[0].get('message', {}))
+
+def handle_updates(updates, deadline=None):
+    """Пачка из альбома или серии текстов подряд - один запрос к модели и один ответ"""
+    if len(updates) == 1:
+        handle_update(updates[0], deadline)
+        return
+    
+    messages = [update['message'] for update in updates]
+    chat_id = messages[0]['chat']['id']
+    user_id = messages[0]['from']['id']
+    text = "\n".join(part for part in (m.get('text') or m.get('caption') or '' for m in messages) if part.strip())
+    photos = [m['photo'] for m in messages if 'photo' in m]
+    
+    if photos:
+        answer_photos(chat_id, user_id, text, photos, deadline=deadline)
+    else:
+        answer_text(chat_id, user_id, text, deadline=deadline)
+
+def reply_deadline(updates):
+    """Момент (time.time()), после которого ответ на пачку уже не нужен - от приёма самого свежего обновления.
+    Не от date сообщения: после сна инстанса или повторной доставки вебхука оно давно в прошлом"""
+    return max(update.get(RECEIVED_AT) or time.time() for update in updates) + REPLY_DEADLINE
+
+def notify_busy(chat_id, reason):
+    """Запрос не будет обработан - сообщаем чату, но не чаще BUSY_NOTICE_INTERVAL"""
+    metrics.shed_updates.inc(reason=reason)
+    logger.warning(f"Shedding work for chat {chat_id}: {reason}")
+    if admission.notice_due(chat_id):
+        media_executor.submit(send_message, chat_id, BUSY_TEXT, None)
+
+def shed_batch(chat_id, jobs):
+    """Пачка вытеснена из переполненной очереди чата: подтверждаем без обработки"""
+    for _, ack in jobs:
+        if ack:
+            ack()
+    notify_busy(chat_id, "overflow")
+
+def merge_batches(pending, jobs):
+    """Новая пачка с тем же ключом склейки (альбом или тексты отправителя) дописывается к ждущей (политика merge)"""
+    keys = {coalesce_key(job) for job in pending + jobs}
+    if None in keys or len(keys) > 1 or len(pending) + len(jobs) > COALESCE_MAX_ITEMS:
+        return None
+    return pending + jobs
+
+def process_batch(jobs):
+    """Обработка пачки обновлений с замером времени (точка входа воркера).
+    jobs - список (обновление, ack); ack подтверждает обновление из общей очереди"""
+    updates = [data for data, _ in jobs]
+    kinds = [update_kind(update.get('message', {})) for update in updates]
+    kind = 'photo' if 'photo' in kinds else kinds[0]
+    
+    for k in kinds:
+        metrics.updates_total.inc(kind=k)
+    if len(updates) > 1:
+        metrics.coalesced_updates.inc(len(updates) - 1)
+    deadline = reply_deadline(updates)
+    try:
+        if kind != 'command' and time.time() >= deadline:
+            # Пачка прождала в очереди дольше дедлайна - модель не спрашиваем
+            notify_busy(updates[0]['message']['chat']['id'], "expired")
+            return
+        with metrics.span(f"update_{kind}"):
+            handle_updates(updates, deadline)
+    finally:
+        if SHARED_STATE:
+            # История сохраняется до подтверждения
+            history_store.flush()
+        for _, ack in jobs:
+            if ack:
+                ack()
+        metrics.mark_startup("first_update")
+
+# === ОЧЕРЕДЬ ОБРАБОТКИ ===
+update_dedup = UpdateDedup()
+# Очередь чата ограничена: лишнее отклоняется, вытесняет старое или склеивается (OVERFLOW_POLICY)
+dispatcher = ChatDispatcher(process_batch, max_chat_pending=CHAT_MAX_PENDING,
+                            merge=merge_batches, on_shed=shed_batch)
+# Альбомы и быстрые серии сообщений копятся короткое окно и уходят одной пачкой
+coalescer = Coalescer(dispatcher.submit, coalesce_key)
+
+shard_consumer = None
+if SHARED_STATE:
+    # Шарды переехали - кэш истории их чатов мог устареть в другом процессе.
+    # Ключ истории в личке совпадает с chat_id, групповые ключи из хэша сбрасываем все
+    shard_consumer = ShardConsumer(
+        SharedUpdateQueue(),
+        lambda chat_id, data, ack: coalescer.submit(chat_id, (data, ack)),
+        on_rebalance=lambda changed: history_store.invalidate(lambda key: key < 0 or shard_for(key) in changed)
+    ).start()
+
+# === МЕТРИКИ СОСТОЯНИЯ ===
+metrics.Gauge("bot_updates_in_flight", "Updates being handled right now", lambda: dispatcher.stats()["in_flight"])
+metrics.Gauge("bot_updates_pending", "Updates waiting in per-chat queues", lambda: dispatcher.stats()["pending"])
+metrics.Gauge("bot_model_slots_active", "Model calls holding an admission slot", lambda: admission.stats()["active"])
+metrics.Gauge("bot_model_slots_waiting", "Model calls waiting for an admission slot", lambda: admission.stats()["waiting"])
+metrics.Gauge("bot_updates_coalescing", "Updates waiting in the coalescing window", lambda: coalescer.stats()["pending"])
+metrics.Gauge("bot_history_cached_users", "Users with history in memory", lambda: history_store.stats()["cached_users"])
+metrics.Gauge("bot_history_cached_bytes", "Approximate size of cached history", lambda: history_store.stats()["cached_bytes"])
+metrics.Gauge("bot_outbound_queue_depth", "Telegram requests waiting for rate limits", lambda: outbound.stats()["queue_depth"])
+metrics.Gauge("bot_outbound_rate_limited", "Telegram 429 responses so far", lambda: outbound.stats()["rate_limited"])
+metrics.Gauge("bot_file_cache_bytes", "Bytes in the on-disk file cache", lambda: file_cache.stats()["bytes"])
+if shard_consumer:
+    metrics.Gauge("bot_owned_shards", "Chat shards owned by this process", lambda: len(shard_consumer.shards))
+    metrics.Gauge("bot_shared_queue_depth", "Updates in the shared queue", lambda: shard_consumer.queue.depth())
+
+# === ПРОГРЕВ ПОСЛЕ ЗАПУСКА ===
+# После сна бесплатного инстанса первый вебхук не должен платить за рукопожатия TLS и чтение с диска
+WARMUP = os.environ.get("BOT_WARMUP", "1") == "1"
+WARMUP_CONNECTIONS = int(os.environ.get("WARMUP_CONNECTIONS", 2))  # Соединений к каждому API
+HISTORY_PRELOAD_USERS = int(os.environ.get("HISTORY_PRELOAD_USERS", 200))
+
+def warm_up():
+    """Фоновый прогрев: соединения к Telegram и OpenRouter, история активных пользователей, кэш ответов"""
+    connections = [
+        media_executor.submit(http_client.prewarm, f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/getMe", WARMUP_CONNECTIONS),
+        media_executor.submit(http_client.prewarm, OPENROUTER_URL, WARMUP_CONNECTIONS),
+    ]
+    try:
+        users = history_store.preload(HISTORY_PRELOAD_USERS)
+        answers = response_cache.load()
+        # PIL нужен только для фото - импортируем заранее, но не на пути запуска
+        try:
+            import PIL.Image  # noqa: F401
+        except ImportError:
+            pass
+        opened = sum(future.result() for future in connections)
+        metrics.mark_startup("warmup")
+        logger.info(f"🔥 Прогрев за {metrics.startup['warmup']}s: {opened} соединений, "
+                    f"история {users} пользователей, {answers} ответов в кэше")
+    except Exception as e:
+        logger.error(f"Warm-up error: {e}")
+
+if WARMUP:
+    threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+
+def enqueue_update(data):
+    """Поставить обновление в очередь чата. False - очередь переполнена, нужно повторить позже"""
+    update_id = data.get('update_id')
+    # Повторная доставка того же обновления - уже в работе, отвечаем успехом
+    if update_id is not None and not update_dedup.check(update_id):
+        logger.info(f"Duplicate update {update_id} skipped")
+        metrics.duplicate_updates.inc()
+        return True
+    
+    message = data.get('message')
+    if not message:
+        return True
+    
+    # Дедлайн ответа считается от приёма, метка едет с обновлением и через общую очередь
+    data[RECEIVED_AT] = time.time()
+    chat_id = message['chat']['id']
+    if shard_consumer:
+        # Обработает процесс-владелец шарда этого чата
+        try:
+            shard_consumer.queue.put(chat_id, data)
+        except Exception as e:
+            logger.error(f"Shared queue error: {e}")
+            accepted = False
+        else:
+            shard_consumer.wake()
+            accepted = True
+    else:
+        accepted = coalescer.submit(chat_id, (data, None))
+
+    if not accepted:
+        logger.warning(f"Update queue is full, rejecting update {update_id}")
+        if update_id is not None:
+            update_dedup.forget(update_id)
+    return accepted
+
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    """Приём обновлений: ставим в очередь чата и сразу отвечаем Telegram"""
+    data = request.json
+    
+    if not data:
+        return jsonify({"error": "No data"}), 400
+    
+    if not enqueue_update(data):
+        return jsonify({"error": "Overloaded"}), 503
     
     return jsonify({"status": "ok"})
 
+def run_polling():
+    """Получение обновлений через getUpdates вместо вебхука.
+    Offset сдвигается только после того, как обновление принято в очередь"""
+    api_url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}"
+    
+    # getUpdates не работает, пока установлен вебхук
+    http_client.post(f"{api_url}/deleteWebhook", json={"drop_pending_updates": False}, timeout=10, idempotent=True)
+    
+    offset = None
+    while True:
+        try:
+            response = http_client.post(f"{api_url}/getUpdates", json={
+                "offset": offset,
+                "timeout": POLLING_TIMEOUT,
+                "limit": POLLING_BATCH,
+                "allowed_updates": ["message"]
+            }, timeout=POLLING_TIMEOUT + 10, idempotent=True)
+            result = response.json()
+        except Exception as e:
+            logger.error(f"getUpdates error: {e}")
+            time.sleep(1)
+            continue
+        
+        if not result.get('ok'):
+            logger.error(f"getUpdates error: {result}")
+            time.sleep(1)
+            continue
+        
+        for update in result['result']:
+            # Очередь переполнена - ждём, а не теряем обновления
+            while not enqueue_update(update):
+                time.sleep(0.5)
+            offset = update['update_id'] + 1
+
 @app.route('/test')
 def test():
-    """Тест работы"""
-    answer = ask_openrouter_with_history([
-        {"role": "system", "content": "Ты полезный ассистент."},
-        {"role": "user", "content": "Привет! Работает?"}
-    ])
+    """Тест работы (?fresh=1 - мимо кэша ответов, с реальным запросом к модели)"""
+    messages = build_messages([], "Привет! Работает?", system_prompt="Ты полезный ассистент.")
+    cache_key = None if request.args.get('fresh') == '1' else response_cache.key(TEXT_MODELS, messages, 1500)
+    answer = response_cache.get(cache_key) if cache_key else None
+    cached = answer is not None
+    if not cached:
+        deadline = time.time() + REPLY_DEADLINE
+        try:
+            # Проверка идёт в общий лимит запросов к модели, как и ответы пользователям
+            with admission.slot("test", deadline) as slot:
+                answer = ask_openrouter_with_history(messages, deadline=deadline, slot=slot)
+        except Overloaded as e:
+            return jsonify({"status": "⏳ Занято", "reason": e.reason}), 503
+        if answer and cache_key:
+            response_cache.put(cache_key, answer)
     
     if answer:
         return jsonify({
             "status": "✅ Работает",
-            "model": MODEL,
+            "cached": cached,
+            "model": text_router.candidates()[0],
             "capabilities": "text + images + memory + send images",
-            "memory_type": "in-memory (max " + str(MAX_HISTORY//2) + " QA pairs)",
+            "memory_type": "sqlite + in-memory cache (" + str(HISTORY_TOKEN_BUDGET) + " token window + rolling summary)",
             "image_support": "Can receive and send images"
         })
     else:
         return jsonify({
             "status": "❌ Ошибка",
-            "model": MODEL
+            "model": text_router.candidates()[0]
         })
 
+@app.route('/status')
+def status():
+    """Состояние очередей: входящие обновления и исходящие запросы к Telegram"""
+    return jsonify({
+        "updates": dispatcher.stats(),
+        "coalescing": coalescer.stats(),
+        "admission": admission.stats(),
+        "outbound": outbound.stats(),
+        "history": history_store.stats(),
+        "models": {"text": text_router.stats(), "vision": vision_router.stats()},
+        "response_cache": response_cache.stats(),
+        "dedup": update_dedup.stats(),
+        "shards": shard_consumer.stats() if shard_consumer else None,
+        "startup": metrics.startup
+    })
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики в формате Prometheus"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route('/send_test_photo')
 def send_test_photo():
     """Тест отправки фото (для проверки)"""
@@ -545,7 +1190,11 @@ def send_test_photo():
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 10000))
     logger.info(f"🚀 Запуск бота с поддержкой фото и памятью диалога")
-    logger.info(f"🧠 Модель: {MODEL}")
-    logger.info(f"💾 Память: сохраняет последние {MAX_HISTORY//2} пар вопрос-ответ")
+    logger.info(f"🧠 Модели: {', '.join(TEXT_MODELS)} (фото: {', '.join(VISION_MODELS)})")
+    logger.info(f"💾 Память: окно {HISTORY_TOKEN_BUDGET} токенов + краткое содержание")
     logger.info(f"🎨 Возможности: получение и отправка изображений")
-    app.run(host='0.0.0.0', port=port, debug=False)
+    if BOT_MODE == "polling":
+        logger.info(f"📥 Режим: long polling (пачки до {POLLING_BATCH} обновлений)")
+        run_polling()
+    else:
+        app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,121 @@
+"""
+Склейка быстрых серий сообщений одного чата.
+Фото альбома (общий media_group_id) и несколько текстов одного отправителя подряд
+собираются в пачку в течение короткого окна и уходят в обработку одним заданием.
+"""
+
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# === КОНФИГУРАЦИЯ ===
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", 0.7))  # Тишина в чате, после которой пачка уходит (0 - выкл.)
+COALESCE_MAX_WAIT = float(os.environ.get("COALESCE_MAX_WAIT", 3))  # Дольше первое сообщение не ждёт
+COALESCE_MAX_ITEMS = int(os.environ.get("COALESCE_MAX_ITEMS", 10))  # В альбоме Telegram до 10 фото
+COALESCE_MAX_PENDING = int(os.environ.get("COALESCE_MAX_PENDING", 1000))
+RETRY_DELAY = 0.5  # Очередь обработки переполнена - повторить сдачу пачки
+
+
+def message_group_key(message):
+    """
+    Ключ склейки сообщения Telegram: фото - по альбому (media_group_id), текст - по отправителю.
+    Отдельное фото, команда и прочее не склеиваются (None). Смена вида сообщения
+    или другой альбом меняет ключ и завершает пачку
+    """
+    if 'photo' in message:
+        group = message.get('media_group_id')
+        return ('album', group) if group else None
+    text = message.get('text') or ''
+    if not text.strip() or text.startswith('/'):
+        return None
+    return ('text', message['from']['id'])
+
+
+class Coalescer:
+    """
+    Копит задания чата и передаёт их списком в submit(chat_id, jobs).
+    group_key(job) - ключ склейки (например, отправитель); None - задание не склеивается
+    и уходит сразу, но после уже накопленной пачки, так что порядок в чате сохраняется.
+    """
+
+    def __init__(self, submit, group_key, window=COALESCE_WINDOW, max_wait=COALESCE_MAX_WAIT,
+                 max_items=COALESCE_MAX_ITEMS, max_pending=COALESCE_MAX_PENDING):
+        self.submit_batch = submit
+        self.group_key = group_key
+        self.window = window
+        self.max_wait = max_wait
+        self.max_items = max_items
+        self.max_pending = max_pending
+        self._cond = threading.Condition()
+        # chat_id -> {"key", "jobs", "first", "deadline"}
+        self._buffers = {}
+        self._pending = 0
+        self._thread = threading.Thread(target=self._loop, name="coalescer", daemon=True)
+        self._thread.start()
+
+    def submit(self, chat_id, job):
+        """Принять задание. False - очередь переполнена, нужно повторить позже"""
+        key = self.group_key(job)
+        with self._cond:
+            buffer = self._buffers.get(chat_id)
+            if buffer is not None and (key is None or key != buffer["key"]):
+                # Серия прервалась - сначала сдаём накопленное
+                if not self._flush(chat_id):
+                    return False
+                buffer = None
+
+            if key is None or self.window <= 0:
+                return self.submit_batch(chat_id, [job])
+
+            if self._pending >= self.max_pending:
+                return False
+
+            now = time.monotonic()
+            if buffer is None:
+                buffer = self._buffers[chat_id] = {"key": key, "jobs": [], "first": now, "deadline": now}
+            buffer["jobs"].append(job)
+            self._pending += 1
+            buffer["deadline"] = min(now + self.window, buffer["first"] + self.max_wait)
+
+            if len(buffer["jobs"]) >= self.max_items:
+                self._flush(chat_id)
+            self._cond.notify()
+            return True
+
+    def stats(self):
+        with self._cond:
+            return {"chats": len(self._buffers), "pending": self._pending}
+
+    def wait_idle(self, timeout=None):
+        """Дождаться, пока все пачки будут сданы в обработку"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._buffers, timeout=timeout)
+
+    def _flush(self, chat_id):
+        """Сдать пачку чата. Вызывается под блокировкой"""
+        buffer = self._buffers[chat_id]
+        if not self.submit_batch(chat_id, buffer["jobs"]):
+            buffer["deadline"] = time.monotonic() + RETRY_DELAY
+            return False
+        del self._buffers[chat_id]
+        self._pending -= len(buffer["jobs"])
+        self._cond.notify_all()
+        return True
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                for chat_id in [c for c, b in self._buffers.items() if b["deadline"] <= now]:
+                    try:
+                        self._flush(chat_id)
+                    except Exception as e:
+                        logger.error(f"Coalescer flush error for chat {chat_id}: {e}")
+                if self._buffers:
+                    timeout = max(0, min(b["deadline"] for b in self._buffers.values()) - time.monotonic())
+                else:
+                    timeout = None
+                self._cond.wait(timeout)
@@ -0,0 +1,102 @@
+"""
+Защита от повторной доставки обновлений Telegram.
+Недавние update_id держатся в кольцевом буфере с множеством для быстрой проверки,
+а индекс в SQLite делает проверку общей для всех процессов и переживает перезапуск.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# === КОНФИГУРАЦИЯ ===
+DATA_DIR = os.environ.get("BOT_DATA_DIR", "data")
+DEDUP_DB_PATH = os.environ.get("DEDUP_DB_PATH", os.path.join(DATA_DIR, "updates.db"))
+DEDUP_CAPACITY = int(os.environ.get("DEDUP_CAPACITY", 10000))  # Сколько последних update_id помнить
+
+
+class UpdateDedup:
+    """Ограниченный индекс увиденных update_id"""
+
+    def __init__(self, path=DEDUP_DB_PATH, capacity=DEDUP_CAPACITY):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._ring = deque()
+        self._seen = set()
+        self._inserts = 0
+        self.duplicates = 0
+        self._conn = None
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY, seen_at REAL NOT NULL)"
+            )
+            rows = self._conn.execute(
+                "SELECT update_id FROM seen_updates ORDER BY update_id DESC LIMIT ?", (capacity,)
+            ).fetchall()
+            for (update_id,) in reversed(rows):
+                self._remember(update_id)
+
+    def check(self, update_id):
+        """
+        True, если обновление новое (и помечает его увиденным).
+        False - дубликат: его уже принял этот или другой процесс.
+        """
+        with self._lock:
+            if update_id in self._seen:
+                self.duplicates += 1
+                return False
+            if self._conn is not None:
+                try:
+                    cursor = self._conn.execute(
+                        "INSERT OR IGNORE INTO seen_updates (update_id, seen_at) VALUES (?, ?)",
+                        (update_id, time.time()),
+                    )
+                    if cursor.rowcount == 0:
+                        self._remember(update_id)
+                        self.duplicates += 1
+                        return False
+                    self._inserts += 1
+                    if self._inserts % max(self.capacity // 10, 1) == 0:
+                        self._prune()
+                except sqlite3.Error as e:
+                    # База недоступна - проверяем хотя бы по памяти процесса
+                    logger.error(f"Dedup index error: {e}")
+            self._remember(update_id)
+            return True
+
+    def forget(self, update_id):
+        """Обновление не принято в обработку - повторная доставка должна пройти"""
+        with self._lock:
+            self._seen.discard(update_id)
+            if self._conn is not None:
+                try:
+                    self._conn.execute("DELETE FROM seen_updates WHERE update_id = ?", (update_id,))
+                except sqlite3.Error as e:
+                    logger.error(f"Dedup index error: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"tracked": len(self._seen), "duplicates": self.duplicates}
+
+    def _remember(self, update_id):
+        self._ring.append(update_id)
+        self._seen.add(update_id)
+        while len(self._ring) > self.capacity:
+            self._seen.discard(self._ring.popleft())
+
+    def _prune(self):
+        """Оставить в базе только последние capacity записей"""
+        self._conn.execute(
+            "DELETE FROM seen_updates WHERE update_id <= "
+            "(SELECT update_id FROM seen_updates ORDER BY update_id DESC LIMIT 1 OFFSET ?)",
+            (self.capacity,),
+        )
@@ -0,0 +1,131 @@
+"""
+Очередь обработки обновлений Telegram.
+Чаты обрабатываются параллельно, сообщения внутри одного чата - строго по порядку.
+Очередь одного чата можно ограничить: лишнее вытесняется по политике переполнения.
+"""
+
+import os
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# === КОНФИГУРАЦИЯ ===
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", 8))
+MAX_PENDING_UPDATES = int(os.environ.get("MAX_PENDING_UPDATES", 1000))
+CHAT_MAX_PENDING = int(os.environ.get("CHAT_MAX_PENDING", 5))  # Ждущих заданий одного чата
+# busy - новое задание отклоняется, drop_oldest - вытесняется самое старое,
+# merge - новое склеивается с последним ждущим (если нельзя - как busy)
+OVERFLOW_POLICY = os.environ.get("OVERFLOW_POLICY", "busy")
+
+
+class ChatDispatcher:
+    """
+    Пул воркеров с отдельной очередью на каждый chat_id.
+    max_chat_pending - предел очереди чата (None - без предела); вытесненное задание
+    передаётся в on_shed(chat_id, задание), merge(последнее, новое) -> склейка или None.
+    """
+
+    def __init__(self, handler, workers=WORKER_THREADS, max_pending=MAX_PENDING_UPDATES,
+                 max_chat_pending=None, overflow=OVERFLOW_POLICY, merge=None, on_shed=None):
+        self.handler = handler
+        self._max_pending = max_pending
+        self._max_chat_pending = max_chat_pending
+        self._overflow_policy = overflow
+        self._merge = merge
+        self._on_shed = on_shed
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat-worker")
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        # chat_id -> очередь ещё не обработанных обновлений.
+        # Ключ есть в словаре, пока по чату работает воркер.
+        self._queues = {}
+        self._pending = 0
+        self._in_flight = 0
+        self._shed = 0
+        self._merged = 0
+
+    def submit(self, chat_id, update):
+        """Поставить обновление в очередь чата. False - если общая очередь переполнена"""
+        shed = None
+        with self._lock:
+            queue = self._queues.get(chat_id)
+            if queue is not None and self._max_chat_pending and len(queue) >= self._max_chat_pending:
+                shed = self._overflow(queue, update)
+            elif self._pending >= self._max_pending:
+                return False
+            elif queue is not None:
+                # По чату уже работает воркер - он заберёт обновление сам
+                self._pending += 1
+                queue.append(update)
+                return True
+            else:
+                self._pending += 1
+                self._queues[chat_id] = deque([update])
+                self._executor.submit(self._run_next, chat_id)
+                return True
+        
+        if shed is not None and self._on_shed:
+            try:
+                self._on_shed(chat_id, shed)
+            except Exception as e:
+                logger.exception(f"Error shedding update for chat {chat_id}: {e}")
+        return True
+
+    def _overflow(self, queue, update):
+        """Очередь чата полна: вернуть вытесненное задание (None - склеено)"""
+        if self._overflow_policy == "merge" and self._merge:
+            merged = self._merge(queue[-1], update)
+            if merged is not None:
+                queue[-1] = merged
+                self._merged += 1
+                return None
+        self._shed += 1
+        if self._overflow_policy == "drop_oldest":
+            oldest = queue.popleft()
+            queue.append(update)
+            return oldest
+        return update
+
+    def _run_next(self, chat_id):
+        """Обработать одно обновление чата и, если есть ещё, вернуть чат в пул"""
+        with self._lock:
+            update = self._queues[chat_id].popleft()
+            self._pending -= 1
+            self._in_flight += 1
+
+        try:
+            self.handler(update)
+        except Exception as e:
+            logger.exception(f"Error handling update for chat {chat_id}: {e}")
+
+        with self._lock:
+            self._in_flight -= 1
+            if not self._queues[chat_id]:
+                del self._queues[chat_id]
+                if not self._queues:
+                    self._idle.notify_all()
+                return
+        # Ставим чат в конец пула, чтобы занятый чат не блокировал остальные
+        self._executor.submit(self._run_next, chat_id)
+
+    def stats(self):
+        """Текущая загрузка очереди"""
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "in_flight": self._in_flight,
+                "active_chats": len(self._queues),
+                "shed": self._shed,
+                "merged": self._merged,
+            }
+
+    def wait_idle(self, timeout=None):
+        """Дождаться, пока все очереди опустеют"""
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._queues, timeout=timeout)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,169 @@
+"""
+Кэш файлов на диске.
+Скачанные байты хранятся по ключу (file_unique_id Telegram или URL) с вытеснением
+по суммарному размеру, а для отправленных картинок запоминается file_id Telegram,
+чтобы повторно отправлять их без загрузки.
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# === КОНФИГУРАЦИЯ ===
+DATA_DIR = os.environ.get("BOT_DATA_DIR", "data")
+FILE_CACHE_DIR = os.environ.get("FILE_CACHE_DIR", os.path.join(DATA_DIR, "files"))
+FILE_CACHE_MAX_BYTES = int(os.environ.get("FILE_CACHE_MAX_BYTES", 200 * 1024 * 1024))
+FILE_ID_DB_PATH = os.environ.get("FILE_ID_DB_PATH", os.path.join(DATA_DIR, "file_ids.db"))
+
+
+def _digest(key):
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class FileCache:
+    """LRU кэш байтов на диске с ограничением общего размера"""
+
+    def __init__(self, directory=FILE_CACHE_DIR, max_bytes=FILE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # digest -> размер, от давно использованных к свежим
+        self._index = OrderedDict()
+        self._total = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """Восстановить индекс по файлам на диске (порядок - по времени доступа)"""
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._index[name] = size
+            self._total += size
+        self._evict()
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def path(self, key):
+        """Путь к файлу в кэше или None"""
+        digest = _digest(key)
+        with self._lock:
+            if digest not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(digest)
+        path = self._path(digest)
+        try:
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def put_stream(self, key, chunks, max_bytes=None, validate=None):
+        """
+        Записать поток кусков прямо на диск, не собирая файл в памяти.
+        validate(первые байты) == False или превышение max_bytes обрывают запись.
+        Возвращает путь к файлу в кэше или None.
+        """
+        digest = _digest(key)
+        path = self._path(digest)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        size = 0
+        head = b""
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    if not chunk:
+                        continue
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        raise ValueError(f"larger than {max_bytes} bytes")
+                    if validate and len(head) < 16:
+                        head = (head + chunk)[:16]
+                        if len(head) == 16 and not validate(head):
+                            raise ValueError("unexpected content type")
+                    f.write(chunk)
+            if validate and len(head) < 16 and not validate(head):
+                raise ValueError("unexpected content type")
+            os.replace(tmp_path, path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"File cache stream rejected for {key[:80]}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return None
+
+        with self._lock:
+            self._total -= self._index.pop(digest, 0)
+            self._index[digest] = size
+            self._total += size
+            self._evict()
+        return path
+
+    def _evict(self):
+        while self._index and self._total > self.max_bytes:
+            digest, size = self._index.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(self._path(digest))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {"files": len(self._index), "bytes": self._total, "hits": self.hits, "misses": self.misses}
+
+
+class FileIdMap:
+    """Соответствие URL картинки и file_id, который Telegram вернул при отправке"""
+
+    def __init__(self, path=FILE_ID_DB_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids ("
+            "url_hash TEXT PRIMARY KEY, file_id TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, url):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_id FROM file_ids WHERE url_hash = ?", (_digest(url),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, url, file_id):
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO file_ids (url_hash, file_id, updated_at) VALUES (?, ?, ?)",
+                    (_digest(url), file_id, time.time()),
+                )
+
+    def forget(self, url):
+        """file_id перестал работать - отправим файл заново"""
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM file_ids WHERE url_hash = ?", (_digest(url),))
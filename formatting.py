@@ -0,0 +1,205 @@
+"""
+Подготовка текста ответа к отправке в Telegram.
+Markdown модели переводится в HTML Telegram локально и проверяется до отправки,
+длинный ответ режется по абзацам и блокам кода в пределах лимита сообщения.
+Лимиты Telegram считаются в единицах UTF-16: эмодзи и прочие символы вне BMP занимают две.
+"""
+
+import re
+import html
+from html.parser import HTMLParser
+
+TELEGRAM_TEXT_LIMIT = 4096
+
+# Теги, которые понимает parse_mode=HTML
+ALLOWED_TAGS = {"b", "i", "s", "u", "code", "pre", "a", "blockquote"}
+
+# Язык блока - только короткое слово на строке с ```, иначе это уже код
+FENCE_PATTERN = re.compile(r"```(?:([\w+-]{1,32})?[ \t]*\n)?(.*?)(?:```|\Z)", re.DOTALL)
+INLINE_CODE_PATTERN = re.compile(r"`([^`\n]+)`")
+LINK_PATTERN = re.compile(r"\[([^\]\n]+)\]\((https?://[^\s)]+)\)")
+HEADING_PATTERN = re.compile(r"^#{1,6}[ \t]+(.+?)[ \t#]*$", re.MULTILINE)
+BULLET_PATTERN = re.compile(r"^([ \t]*)[*+-][ \t]+", re.MULTILINE)
+BOLD_PATTERN = re.compile(r"(\*\*|__)(?=\S)(.+?)(?<=\S)\1")
+ITALIC_PATTERN = re.compile(r"(?<![\w*])\*(?=\S)([^*\n]+?)(?<=\S)\*(?![\w*])|(?<!\w)_(?=\S)([^_\n]+?)(?<=\S)_(?!\w)")
+STRIKE_PATTERN = re.compile(r"~~(?=\S)(.+?)(?<=\S)~~")
+PLACEHOLDER_PATTERN = re.compile("\x00(\\d+)\x00")
+
+
+def utf16_len(text):
+    """Длина в единицах UTF-16 - так Telegram считает лимиты текста и подписей"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def utf16_prefix(text, limit):
+    """Самое длинное начало text не длиннее limit единиц UTF-16 (но хотя бы один символ)"""
+    used = 0
+    for i, char in enumerate(text):
+        used += 2 if ord(char) > 0xFFFF else 1
+        if used > limit:
+            return text[:max(i, 1)]
+    return text
+
+
+def _inline(text):
+    """Строчная разметка вне блоков кода"""
+    stash = []
+    # \x00 служит меткой спрятанного фрагмента - в самом тексте его быть не должно
+    text = text.replace("\x00", "")
+
+    def keep(fragment):
+        stash.append(fragment)
+        return f"\x00{len(stash) - 1}\x00"
+
+    # Код и ссылки прячем, чтобы * и _ внутри них не стали разметкой
+    text = INLINE_CODE_PATTERN.sub(lambda m: keep(f"<code>{html.escape(m.group(1), quote=False)}</code>"), text)
+    text = LINK_PATTERN.sub(lambda m: keep(
+        f'<a href="{html.escape(m.group(2))}">{html.escape(m.group(1), quote=False)}</a>'), text)
+
+    text = html.escape(text, quote=False)
+    text = HEADING_PATTERN.sub(r"<b>\1</b>", text)
+    text = BULLET_PATTERN.sub(r"\1• ", text)
+    text = BOLD_PATTERN.sub(r"<b>\2</b>", text)
+    text = ITALIC_PATTERN.sub(lambda m: f"<i>{m.group(1) or m.group(2)}</i>", text)
+    text = STRIKE_PATTERN.sub(r"<s>\1</s>", text)
+    return PLACEHOLDER_PATTERN.sub(lambda m: stash[int(m.group(1))], text)
+
+
+def markdown_to_html(text):
+    """Markdown модели -> HTML для parse_mode=HTML. Незакрытый блок кода закрывается"""
+    parts = []
+    position = 0
+    for match in FENCE_PATTERN.finditer(text):
+        parts.append(_inline(text[position:match.start()]))
+        language, code = match.group(1), match.group(2).rstrip("\n")
+        attr = f' class="language-{language}"' if language else ""
+        parts.append(f"<pre><code{attr}>{html.escape(code, quote=False)}</code></pre>")
+        position = match.end()
+    parts.append(_inline(text[position:]))
+    return "".join(parts)
+
+
+class _TagChecker(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.valid = True
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in ALLOWED_TAGS:
+            self.valid = False
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack.pop() != tag:
+            self.valid = False
+
+
+def is_valid_html(text):
+    """Только разрешённые теги и правильная вложенность - Telegram не ответит 400"""
+    checker = _TagChecker()
+    try:
+        checker.feed(text)
+        checker.close()
+    except Exception:
+        return False
+    return checker.valid and not checker.stack
+
+
+def _blocks(text):
+    """Абзацы и блоки кода целиком (внутри блока кода пустые строки не режут)"""
+    blocks = []
+    position = 0
+    for match in FENCE_PATTERN.finditer(text):
+        blocks.extend(b for b in re.split(r"\n\s*\n", text[position:match.start()]) if b.strip())
+        blocks.append(match.group(0).strip("\n"))
+        position = match.end()
+    blocks.extend(b for b in re.split(r"\n\s*\n", text[position:]) if b.strip())
+    return blocks
+
+
+def _split_block(block, limit):
+    """Слишком длинный блок - по строкам; блок кода в каждой части заново обрамляется"""
+    fence = FENCE_PATTERN.fullmatch(block)
+    opening, closing = (f"```{fence.group(1) or ''}\n", "\n```") if fence else ("", "")
+    budget = limit - utf16_len(opening) - utf16_len(closing)
+    if fence and budget > 0:
+        body = fence.group(2).rstrip("\n")
+    else:
+        # Обрамление не помещается в часть - режем как обычный текст
+        opening, body, closing, budget = "", block, "", max(limit, 1)
+
+    pieces, current = [], ""
+    for line in body.split("\n"):
+        while utf16_len(line) > budget:
+            if current:
+                pieces.append(current)
+                current = ""
+            head = utf16_prefix(line, budget)
+            pieces.append(head)
+            line = line[len(head):]
+        if current and utf16_len(current) + 1 + utf16_len(line) > budget:
+            pieces.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        pieces.append(current)
+    return [f"{opening}{piece}{closing}" for piece in pieces]
+
+
+def split_text(text, limit=TELEGRAM_TEXT_LIMIT):
+    """Разбить текст на части не длиннее limit (в UTF-16) по границам абзацев и блоков кода"""
+    if utf16_len(text) <= limit:
+        return [text] if text.strip() else []
+    chunks, current = [], ""
+    for block in _blocks(text):
+        for piece in ([block] if utf16_len(block) <= limit else _split_block(block, limit)):
+            if current and utf16_len(current) + 2 + utf16_len(piece) > limit:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def render_chunks(text, limit=TELEGRAM_TEXT_LIMIT):
+    """
+    Части ответа, готовые к отправке: [(исходный текст, HTML или None)].
+    None - HTML не прошёл проверку, часть сразу уходит простым текстом без неудачного запроса.
+    Длина считается по исходнику в UTF-16: видимый текст после разметки не длиннее.
+    """
+    rendered = []
+    for chunk in split_text(text, limit):
+        converted = markdown_to_html(chunk)
+        rendered.append((chunk, converted if is_valid_html(converted) else None))
+    return rendered
+
+
+def deliver_chunks(chunks, send, on_fallback=None):
+    """
+    Отправить части из render_chunks через send(текст, parse_mode) -> bool, по порядку.
+    Без HTML или если Telegram его не принял - исходный текст уходит совсем без разметки
+    (on_fallback() - для учёта таких случаев)
+    """
+    ok = True
+    for plain, formatted in chunks:
+        if formatted is not None:
+            if send(formatted, "HTML"):
+                continue
+            if on_fallback:
+                on_fallback()
+        ok = send(plain, None) and ok
+    return ok
+
+
+def deliver_text(text, send, parse_mode="Markdown", on_fallback=None):
+    """Markdown переводится в HTML заранее, с другим parse_mode текст только режется на части"""
+    if parse_mode == "Markdown":
+        return deliver_chunks(render_chunks(text), send, on_fallback)
+    ok = True
+    for chunk in split_text(text):
+        ok = send(chunk, parse_mode) and ok
+    return ok
@@ -0,0 +1,31 @@
+"""
+Настройки gunicorn. По умолчанию один процесс.
+WEB_CONCURRENCY > 1 - режим масштабирования: бот включает общую очередь
+обновлений (shared_state.py), каждый чат обслуживает один процесс,
+лимиты Telegram делятся между процессами. Все процессы должны видеть один BOT_DATA_DIR.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+# Вебхук только ставит обновление в очередь - потоков хватает немного
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+worker_class = "gthread"
+timeout = 60
+# Без preload: потоки очередей и пулы соединений создаются в каждом процессе после fork
+preload_app = False
+
+if workers > 1:
+    os.environ.setdefault("BOT_SHARED_STATE", "1")
+    # Общий лимит Telegram делим между процессами
+    os.environ.setdefault("TG_GLOBAL_RATE", str(30 / workers))
+    os.environ.setdefault("TG_GLOBAL_BURST", str(30 / workers))
+
+
+def worker_exit(server, worker):
+    """Отдать шарды сразу, не дожидаясь истечения аренды"""
+    import bot
+    if bot.shard_consumer:
+        bot.shard_consumer.stop()
+    bot.history_store.close()
@@ -0,0 +1,364 @@
+"""
+Хранилище истории диалогов.
+Горячий LRU/TTL кэш в памяти перед постоянным хранилищем (SQLite в режиме WAL),
+ленивая загрузка по пользователю и пакетная отложенная запись.
+История ограничена бюджетом токенов, выпавшие сообщения сворачиваются
+в краткое содержание, которое хранится первым сообщением с ролью system.
+"""
+
+import os
+import json
+import time
+import atexit
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from tokens import count_message_tokens
+
+logger = logging.getLogger(__name__)
+
+# === КОНФИГУРАЦИЯ ===
+DATA_DIR = os.environ.get("BOT_DATA_DIR", "data")
+HISTORY_BACKEND = os.environ.get("HISTORY_BACKEND", "sqlite")  # sqlite | memory
+HISTORY_DB_PATH = os.environ.get("HISTORY_DB_PATH", os.path.join(DATA_DIR, "history.db"))
+HISTORY_CACHE_USERS = int(os.environ.get("HISTORY_CACHE_USERS", 1000))  # Пользователей в памяти
+HISTORY_CACHE_BYTES = int(os.environ.get("HISTORY_CACHE_BYTES", 16 * 1024 * 1024))  # Потолок памяти кэша
+HISTORY_CACHE_TTL = float(os.environ.get("HISTORY_CACHE_TTL", 3600))  # Секунды без обращений
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", 2.0))
+# Свёртка пачкой: при переполнении выпадает столько, чтобы освободить запас,
+# и запрос на краткое содержание делается раз в несколько ходов, а не на каждый
+HISTORY_FOLD_TOKENS = int(os.environ.get("HISTORY_FOLD_TOKENS", 600))
+HISTORY_FOLD_MESSAGES = int(os.environ.get("HISTORY_FOLD_MESSAGES", 10))
+
+SUMMARY_PREFIX = "Краткое содержание более раннего разговора:\n"
+
+
+class SQLiteHistoryBackend:
+    """Постоянное хранилище истории в SQLite"""
+
+    def __init__(self, path=HISTORY_DB_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "user_id INTEGER PRIMARY KEY, messages TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def load(self, user_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT messages FROM history WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def recent(self, limit):
+        """Истории недавно активных пользователей: [(user_id, сообщения)], свежие первыми"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, messages FROM history ORDER BY updated_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [(user_id, json.loads(messages)) for user_id, messages in rows]
+
+    def save_many(self, items):
+        """items: {user_id: список сообщений или None для удаления}"""
+        now = time.time()
+        upserts = [(uid, json.dumps(msgs, ensure_ascii=False), now) for uid, msgs in items.items() if msgs]
+        deletes = [(uid,) for uid, msgs in items.items() if not msgs]
+        with self._lock:
+            with self._conn:
+                if upserts:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO history (user_id, messages, updated_at) VALUES (?, ?, ?)",
+                        upserts,
+                    )
+                if deletes:
+                    self._conn.executemany("DELETE FROM history WHERE user_id = ?", deletes)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class MemoryHistoryBackend:
+    """Хранилище без сохранения на диск (для тестов и разработки)"""
+
+    def __init__(self):
+        self._data = {}
+
+    def load(self, user_id):
+        return self._data.get(user_id)
+
+    def recent(self, limit):
+        return []
+
+    def save_many(self, items):
+        for uid, msgs in items.items():
+            if msgs:
+                self._data[uid] = msgs
+            else:
+                self._data.pop(uid, None)
+
+    def close(self):
+        pass
+
+
+def history_key(chat_id, user_id):
+    """
+    Ключ истории. В личке это user_id (он же chat_id), в группе у пользователя своя
+    история в каждом чате - отрицательный ключ из хэша, с user_id он не пересекается.
+    Так историю чата ведёт тот же процесс, что и сам чат (шарды по chat_id)
+    """
+    if chat_id == user_id:
+        return user_id
+    digest = hashlib.blake2b(f"{chat_id}:{user_id}".encode(), digest_size=7).digest()
+    return -1 - int.from_bytes(digest, "big")
+
+
+def _split(history):
+    """Разделить историю на сообщение с кратким содержанием и обычные сообщения"""
+    if history and history[0].get("role") == "system":
+        return history[0], history[1:]
+    return None, history
+
+
+def _size_of(messages):
+    """Грубая оценка памяти, занятой историей пользователя"""
+    return sum(len(json.dumps(m, ensure_ascii=False)) for m in messages)
+
+
+class HistoryStore:
+    """История диалогов: горячий кэш + отложенная запись в backend"""
+
+    def __init__(self, backend, max_messages, token_budget=None, on_evict=None,
+                 cache_users=HISTORY_CACHE_USERS, cache_bytes=HISTORY_CACHE_BYTES,
+                 ttl=HISTORY_CACHE_TTL, flush_interval=HISTORY_FLUSH_INTERVAL,
+                 fold_tokens=HISTORY_FOLD_TOKENS, fold_messages=HISTORY_FOLD_MESSAGES):
+        self.backend = backend
+        self.max_messages = max_messages
+        self.token_budget = token_budget
+        self.fold_tokens = fold_tokens
+        self.fold_messages = fold_messages
+        # on_evict(user_id, messages) - сообщения, выпавшие из окна истории
+        self.on_evict = on_evict
+        self._cache_users = cache_users
+        self._cache_bytes = cache_bytes
+        self._ttl = ttl
+        self._lock = threading.RLock()
+        # user_id -> (сообщения, размер, время последнего обращения)
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        # Изменения, ещё не записанные в backend, и пакет, который пишется сейчас
+        self._dirty = {}
+        self._flushing = {}
+        # Записи идут по одной: пакеты не обгоняют друг друга, flush() ждёт текущую запись
+        self._flush_lock = threading.Lock()
+
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, args=(flush_interval,),
+                                         name="history-flush", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    # --- чтение ---
+
+    def get(self, user_id):
+        """Вся сохранённая история пользователя (копия)"""
+        with self._lock:
+            return list(self._load(user_id))
+
+    def window(self, user_id, token_budget):
+        """Краткое содержание и самые свежие сообщения, укладывающиеся в бюджет токенов"""
+        with self._lock:
+            summary, turns = _split(self._load(user_id))
+        selected = []
+        used = count_message_tokens(summary) if summary else 0
+        for message in reversed(turns):
+            used += count_message_tokens(message)
+            if used > token_budget:
+                break
+            selected.append(message)
+        selected.reverse()
+        return ([summary] if summary else []) + selected
+
+    def summary(self, user_id):
+        """Текущее краткое содержание или None"""
+        with self._lock:
+            summary, _ = _split(self._load(user_id))
+        return summary["content"][len(SUMMARY_PREFIX):] if summary else None
+
+    # --- запись ---
+
+    def append(self, user_id, *messages):
+        """
+        Добавить сообщения. При выходе за предел числа сообщений или бюджета токенов
+        старые сообщения выпадают пачкой - до предела минус fold_messages / fold_tokens -
+        и целиком уходят в on_evict
+        """
+        with self._lock:
+            summary, turns = _split(self._load(user_id))
+            turns = turns + list(messages)
+            total = sum(count_message_tokens(m) for m in turns)
+            dropped = []
+            if len(turns) > self.max_messages or (self.token_budget and total > self.token_budget):
+                max_messages = max(0, self.max_messages - self.fold_messages)
+                token_budget = max(0, self.token_budget - self.fold_tokens) if self.token_budget else None
+                while turns and (len(turns) > max_messages or (token_budget is not None and total > token_budget)):
+                    message = turns.pop(0)
+                    total -= count_message_tokens(message)
+                    dropped.append(message)
+            self._put(user_id, ([summary] if summary else []) + turns)
+
+        if dropped and self.on_evict:
+            self.on_evict(user_id, dropped)
+
+    def set_summary(self, user_id, text, expected=None):
+        """
+        Заменить краткое содержание.
+        Если текущее уже не равно expected (его успели обновить или историю очистили) - ничего не делаем.
+        """
+        with self._lock:
+            summary, turns = _split(self._load(user_id))
+            current = summary["content"][len(SUMMARY_PREFIX):] if summary else None
+            # Историю очистили - старое содержание не возвращаем
+            if current != expected or not turns:
+                return False
+            self._put(user_id, [{"role": "system", "content": SUMMARY_PREFIX + text}] + turns)
+            return True
+
+    def clear(self, user_id):
+        with self._lock:
+            self._put(user_id, [])
+
+    def preload(self, limit):
+        """Прогрев после запуска: история недавно активных пользователей сразу в памяти"""
+        rows = self.backend.recent(min(limit, self._cache_users))
+        now = time.monotonic()
+        loaded = 0
+        with self._lock:
+            # Самые свежие добавляются последними - их LRU вытеснит позже всех
+            for user_id, history in reversed(rows):
+                if history and user_id not in self._cache and user_id not in self._dirty \
+                        and user_id not in self._flushing:
+                    self._remember(user_id, history, now)
+                    loaded += 1
+        return loaded
+
+    def invalidate(self, predicate):
+        """Выгрузить из памяти пользователей, чью историю мог изменить другой процесс"""
+        with self._lock:
+            for user_id in [uid for uid in self._cache if predicate(uid) and uid not in self._dirty]:
+                self._forget(user_id)
+
+    def flush(self):
+        """Записать накопленные изменения одним пакетом. Возвращается, когда записано
+        всё, что изменили до вызова, в том числе пакетом другого потока"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                batch, self._dirty = self._dirty, {}
+                self._flushing = batch
+            try:
+                self.backend.save_many(batch)
+            except Exception as e:
+                logger.error(f"History flush error: {e}")
+                # Возвращаем несохранённое, не затирая более свежие изменения
+                with self._lock:
+                    for uid, msgs in batch.items():
+                        self._dirty.setdefault(uid, msgs)
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def close(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self.flush()
+        self.backend.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "cached_users": len(self._cache),
+                "cached_bytes": self._cache_size,
+                "dirty_users": len(self._dirty),
+            }
+
+    # --- внутреннее ---
+
+    def _load(self, user_id):
+        now = time.monotonic()
+        entry = self._cache.get(user_id)
+        if entry is not None and now - entry[2] <= self._ttl:
+            self._cache[user_id] = (entry[0], entry[1], now)
+            self._cache.move_to_end(user_id)
+            return entry[0]
+
+        if user_id in self._dirty:
+            history = self._dirty[user_id] or []
+        elif user_id in self._flushing:
+            history = self._flushing[user_id] or []
+        else:
+            history = self.backend.load(user_id) or []
+        # Пустую историю не кэшируем, чтобы чтение не создавало записей
+        if history:
+            self._remember(user_id, history, now)
+        else:
+            self._forget(user_id)
+        return history
+
+    def _put(self, user_id, history):
+        self._dirty[user_id] = history
+        if history:
+            self._remember(user_id, history, time.monotonic())
+        else:
+            self._forget(user_id)
+
+    def _remember(self, user_id, history, now):
+        self._forget(user_id)
+        size = _size_of(history)
+        self._cache[user_id] = (history, size, now)
+        self._cache_size += size
+        # Вытесняем самых давних пользователей: они остаются в backend или _dirty
+        while self._cache and (len(self._cache) > self._cache_users or self._cache_size > self._cache_bytes):
+            _, (_, evicted_size, _) = self._cache.popitem(last=False)
+            self._cache_size -= evicted_size
+
+    def _forget(self, user_id):
+        entry = self._cache.pop(user_id, None)
+        if entry is not None:
+            self._cache_size -= entry[1]
+
+    def _expire(self):
+        """Выгрузить из памяти пользователей, к которым давно не обращались"""
+        now = time.monotonic()
+        with self._lock:
+            while self._cache:
+                user_id, (_, size, accessed) = next(iter(self._cache.items()))
+                if now - accessed <= self._ttl:
+                    break
+                del self._cache[user_id]
+                self._cache_size -= size
+
+    def _flush_loop(self, interval):
+        while not self._stop.wait(interval):
+            self.flush()
+            self._expire()
+
+
+def create_history_store(max_messages, token_budget=None, on_evict=None):
+    """Хранилище истории по настройке HISTORY_BACKEND"""
+    if HISTORY_BACKEND == "memory":
+        backend = MemoryHistoryBackend()
+    else:
+        backend = SQLiteHistoryBackend(HISTORY_DB_PATH)
+    return HistoryStore(backend, max_messages, token_budget=token_budget, on_evict=on_evict)
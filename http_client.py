@@ -0,0 +1,208 @@
+"""
+Общий HTTP-клиент для Telegram и OpenRouter.
+Постоянные пулы соединений для зарегистрированных хостов API, одна общая
+ограниченная сессия для всех остальных (картинки по произвольным URL),
+бюджет времени на вызов и повторы с джиттером только там, где это безопасно.
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# === КОНФИГУРАЦИЯ ===
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 20))  # Соединений на хост API
+# Прочие хосты: сколько пулов держать (старые закрываются по LRU) и соединений в каждом
+EXTERNAL_POOL_HOSTS = int(os.environ.get("EXTERNAL_POOL_HOSTS", 8))
+EXTERNAL_POOL_SIZE = int(os.environ.get("EXTERNAL_POOL_SIZE", 2))
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", 3))
+HTTP_BACKOFF_BASE = float(os.environ.get("HTTP_BACKOFF_BASE", 0.5))  # Секунды
+HTTP_BACKOFF_MAX = float(os.environ.get("HTTP_BACKOFF_MAX", 8))
+DEFAULT_TIMEOUT = 30
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+_pooled_hosts = set()
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def register_hosts(*urls):
+    """Хосты из URL получат свой пул на HTTP_POOL_SIZE соединений (API Telegram и OpenRouter)"""
+    with _sessions_lock:
+        _pooled_hosts.update(urlsplit(url).netloc for url in urls)
+
+
+def _new_session(pool_connections, pool_maxsize):
+    session = requests.Session()
+    # Повторы делаем сами - у urllib3 нет бюджета времени и retry_after Telegram
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(url):
+    """
+    Сессия для хоста из URL: своя у зарегистрированных хостов, общая у остальных.
+    В общей не больше EXTERNAL_POOL_HOSTS пулов - число хостов не растёт без предела
+    """
+    host = urlsplit(url).netloc
+    key = host if host in _pooled_hosts else None
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            if key is None:
+                session = _new_session(EXTERNAL_POOL_HOSTS, EXTERNAL_POOL_SIZE)
+            else:
+                session = _new_session(1, HTTP_POOL_SIZE)
+            _sessions[key] = session
+    return session
+
+
+def prewarm(url, connections=1, timeout=10):
+    """
+    Заранее открыть соединения (TCP + TLS) к хосту URL параллельными HEAD-запросами,
+    чтобы первый настоящий запрос после запуска не ждал рукопожатий.
+    Код ответа не важен - соединение остаётся в пуле. Возвращает число удачных.
+    """
+    opened = []
+
+    def touch():
+        try:
+            request("HEAD", url, timeout=timeout, retries=0)
+            opened.append(True)
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Prewarm of {urlsplit(url).netloc} failed: {e}")
+
+    threads = [threading.Thread(target=touch, name="prewarm", daemon=True) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(opened)
+
+
+def close_all():
+    """Закрыть все пулы соединений"""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def _retry_after(response):
+    """Сколько ждать перед повтором по ответу 429 (Telegram кладёт это в JSON)"""
+    try:
+        return float(response.json()["parameters"]["retry_after"])
+    except Exception:
+        pass
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _endpoint(url):
+    """Метки для метрик: куда идёт запрос и какой метод API (без токена в пути)"""
+    parts = urlsplit(url).path.strip("/").split("/")
+    if parts[0].startswith("bot"):
+        return "telegram", parts[-1]
+    if parts[0] == "file" and len(parts) > 1 and parts[1].startswith("bot"):
+        return "telegram", "file"
+    if parts[-2:] == ["chat", "completions"]:
+        return "openrouter", "chat/completions"
+    # Произвольные URL картинок - без пути, чтобы не плодить метки
+    return "external", "download"
+
+
+def _observe(started, target, endpoint, status):
+    metrics.http_seconds.observe(time.monotonic() - started, target=target, endpoint=endpoint, status=status)
+
+
+def _backoff(attempt):
+    """Экспоненциальная задержка с полным джиттером"""
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+
+def request(method, url, timeout=DEFAULT_TIMEOUT, retries=HTTP_MAX_RETRIES, idempotent=None,
+            retry_on_429=True, **kwargs):
+    """
+    HTTP-запрос через общий пул.
+    timeout - общий бюджет на все попытки в секундах.
+    429 повторяется всегда (запрос не был обработан), если retry_on_429 - иначе ответ
+    возвращается вызывающему (так делает планировщик Telegram). 5xx и обрывы
+    соединения повторяются только для идемпотентных запросов.
+    """
+    method = method.upper()
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+
+    session = get_session(url)
+    target, endpoint = _endpoint(url)
+    deadline = time.monotonic() + timeout
+    attempt = 0
+
+    while True:
+        remaining = deadline - time.monotonic()
+        started = time.monotonic()
+        try:
+            response = session.request(method, url, timeout=max(remaining, 0.1), **kwargs)
+        except requests.exceptions.ConnectTimeout:
+            _observe(started, target, endpoint, "connect_timeout")
+            # Соединение не установилось - запрос точно не отправлен
+            delay = _backoff(attempt)
+            if attempt >= retries or time.monotonic() + delay >= deadline:
+                raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+            _observe(started, target, endpoint, "connection_error")
+            delay = _backoff(attempt)
+            if not idempotent or attempt >= retries or time.monotonic() + delay >= deadline:
+                raise
+        except requests.exceptions.Timeout:
+            _observe(started, target, endpoint, "timeout")
+            raise
+        except requests.exceptions.RequestException:
+            _observe(started, target, endpoint, "error")
+            raise
+        else:
+            _observe(started, target, endpoint, response.status_code)
+            if response.status_code == 429:
+                if not retry_on_429:
+                    return response
+                delay = _retry_after(response)
+                if delay is None:
+                    delay = _backoff(attempt)
+            elif response.status_code >= 500 and idempotent:
+                delay = _backoff(attempt)
+            else:
+                return response
+            if attempt >= retries or time.monotonic() + delay >= deadline:
+                return response
+            # Ответ не нужен - соединение (и поток stream=True) сразу возвращается в пул
+            response.close()
+
+        attempt += 1
+        logger.warning(f"Retrying {method} {urlsplit(url).netloc} in {delay:.2f}s (attempt {attempt})")
+        time.sleep(delay)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
@@ -0,0 +1,268 @@
+"""
+Подготовка входящих фото для vision-модели:
+выбор подходящего размера из Telegram, уменьшение и перекодирование,
+определение настоящего MIME типа.
+Потоковые тела запросов (multipart и JSON с картинками в base64),
+чтобы файл не держался в памяти целиком.
+"""
+
+import io
+import os
+import re
+import json
+import uuid
+import base64
+import hashlib
+import logging
+from io import BytesIO
+
+logger = logging.getLogger(__name__)
+
+# === КОНФИГУРАЦИЯ ===
+VISION_TARGET_SIDE = int(os.environ.get("VISION_TARGET_SIDE", 1024))  # Длинная сторона для модели
+VISION_MAX_BYTES = int(os.environ.get("VISION_MAX_BYTES", 512 * 1024))
+VISION_JPEG_QUALITY = int(os.environ.get("VISION_JPEG_QUALITY", 85))
+DOWNLOAD_MAX_BYTES = int(os.environ.get("DOWNLOAD_MAX_BYTES", 20 * 1024 * 1024))  # Bot API отдаёт файлы до 20 МБ
+CHUNK_SIZE = 48 * 1024  # Кратно 3, чтобы base64 кусков склеивался без паддинга
+
+# Форматы, которые vision-модели принимают как есть
+SUPPORTED_MIME_TYPES = {"image/jpeg", "image/png", "image/webp", "image/gif"}
+
+
+class LocalFile:
+    """
+    Файл на диске (например, в кэше) вместо байтов в памяти.
+    Дескриптор открывается сразу: если кэш вытеснит файл во время загрузки,
+    данные дочитываются через открытый дескриптор. Чтение - pread по смещению,
+    так что повторы запросов и параллельные читатели друг другу не мешают.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self._fd).st_size
+
+    def pread(self, n, offset):
+        return os.pread(self._fd, n, offset)
+
+    def head(self, n=16):
+        return self.pread(n, 0)
+
+    def open(self):
+        """Файловый объект со своей позицией (для Pillow)"""
+        return io.BufferedReader(_FileView(self))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
+
+
+class _FileView(io.RawIOBase):
+    """Чтение LocalFile со своей позицией; дескриптор остаётся у LocalFile"""
+
+    def __init__(self, source):
+        self._source = source
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._source.pread(len(buffer), self._position)
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self._source.size}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+def iter_chunks(source, chunk_size=CHUNK_SIZE):
+    """Куски байтов или LocalFile"""
+    if isinstance(source, LocalFile):
+        offset = 0
+        while True:
+            chunk = source.pread(chunk_size, offset)
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield chunk
+    else:
+        view = memoryview(source)
+        for i in range(0, len(view), chunk_size):
+            yield view[i:i + chunk_size]
+
+
+def source_size(source):
+    return source.size if isinstance(source, LocalFile) else len(source)
+
+
+def source_digest(source):
+    """sha256 содержимого без чтения файла целиком"""
+    digest = hashlib.sha256()
+    for chunk in iter_chunks(source):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_image(head):
+    """Первые байты похожи на картинку"""
+    return sniff_mime_type(head).startswith("image/")
+
+
+def choose_photo_size(photos, target_side=VISION_TARGET_SIDE):
+    """Самый маленький PhotoSize, у которого длинная сторона не меньше target_side"""
+    photos = sorted(photos, key=lambda p: p.get('width', 0) * p.get('height', 0))
+    for photo in photos:
+        if max(photo.get('width', 0), photo.get('height', 0)) >= target_side:
+            return photo
+    # Все меньше цели - берём самое большое
+    return photos[-1]
+
+
+def sniff_mime_type(data):
+    """Определить тип изображения по первым байтам"""
+    if data.startswith(b'\xff\xd8\xff'):
+        return "image/jpeg"
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return "image/png"
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return "image/gif"
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return "image/webp"
+    if data[:2] == b'BM':
+        return "image/bmp"
+    return "application/octet-stream"
+
+
+def prepare_image(source, max_side=VISION_TARGET_SIDE, max_bytes=VISION_MAX_BYTES):
+    """
+    Уменьшить изображение до max_side и уложить в max_bytes.
+    source - байты или LocalFile. Возвращает (данные, MIME тип).
+    Если уменьшать не нужно или Pillow нет - отдаёт исходник как есть.
+    """
+    is_file = isinstance(source, LocalFile)
+    mime_type = sniff_mime_type(source.head() if is_file else source[:16])
+    try:
+        from PIL import Image
+    except ImportError:
+        return source, mime_type
+
+    try:
+        # Pillow читает файл сам, без копии в памяти
+        img = Image.open(source.open() if is_file else BytesIO(source))
+        if (mime_type in SUPPORTED_MIME_TYPES and source_size(source) <= max_bytes
+                and max(img.size) <= max_side):
+            return source, mime_type
+
+        img.thumbnail((max_side, max_side))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        # Снижаем качество, пока не уложимся в лимит
+        quality = VISION_JPEG_QUALITY
+        while True:
+            buffer = BytesIO()
+            img.save(buffer, format="JPEG", quality=quality, optimize=True)
+            if buffer.tell() <= max_bytes or quality <= 40:
+                break
+            quality -= 15
+        return buffer.getvalue(), "image/jpeg"
+    except Exception as e:
+        logger.error(f"Error preparing image: {e}")
+        return source, mime_type
+
+
+# === ПОТОКОВЫЕ ТЕЛА ЗАПРОСОВ ===
+# requests отправляет итерируемое тело по кускам, а по __len__ ставит Content-Length.
+# Тело перечитывается заново при каждой попытке, поэтому повторы запросов работают.
+
+_PLACEHOLDER_NONCE = uuid.uuid4().hex
+
+
+def image_placeholder(index):
+    """Метка в JSON, вместо которой при отправке пишется data: URL картинки images[index]"""
+    return f"@@{_PLACEHOLDER_NONCE}:{index}@@"
+
+
+class DataUrlJSONBody:
+    """JSON-тело, где картинки кодируются в base64 кусками прямо во время отправки"""
+
+    content_type = "application/json"
+
+    def __init__(self, payload, images):
+        """payload - готовый JSON строкой или словарь, images - [(байты или LocalFile, mime)]"""
+        self.images = images
+        text = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+        # Чётные элементы - куски JSON, нечётные - номера картинок
+        self.parts = re.split(f"@@{_PLACEHOLDER_NONCE}:(\\d+)@@", text)
+
+    def _image_prefix(self, index):
+        return f"data:{self.images[index][1]};base64,".encode("ascii")
+
+    def __len__(self):
+        total = 0
+        for i, part in enumerate(self.parts):
+            if i % 2 == 0:
+                total += len(part.encode("utf-8"))
+            else:
+                index = int(part)
+                total += len(self._image_prefix(index)) + 4 * ((source_size(self.images[index][0]) + 2) // 3)
+        return total
+
+    def __iter__(self):
+        for i, part in enumerate(self.parts):
+            if i % 2 == 0:
+                yield part.encode("utf-8")
+                continue
+            index = int(part)
+            yield self._image_prefix(index)
+            for chunk in iter_chunks(self.images[index][0]):
+                yield base64.b64encode(chunk)
+
+
+class MultipartBody:
+    """multipart/form-data, файлы читаются кусками (requests собирает multipart целиком в памяти)"""
+
+    def __init__(self, fields, files):
+        """fields: {имя: значение}, files: {имя: (имя файла, байты или LocalFile, mime)}"""
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self._items = []
+        for name, value in fields.items():
+            header = (f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+                      f'{value}\r\n').encode("utf-8")
+            self._items.append((header, None))
+        for name, (filename, source, mime) in files.items():
+            header = (f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                      f'filename="{filename}"\r\nContent-Type: {mime}\r\n\r\n').encode("utf-8")
+            self._items.append((header, source))
+        self._closing = f"--{self.boundary}--\r\n".encode("ascii")
+
+    def __len__(self):
+        total = len(self._closing)
+        for header, source in self._items:
+            total += len(header)
+            if source is not None:
+                total += source_size(source) + 2
+        return total
+
+    def __iter__(self):
+        for header, source in self._items:
+            yield header
+            if source is not None:
+                yield from iter_chunks(source)
+                yield b"\r\n"
+        yield self._closing
@@ -0,0 +1,194 @@
+"""
+Метрики в формате Prometheus без внешних зависимостей:
+счётчики, гистограммы, gauge через функции и замер этапов span().
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+# Секунды: от быстрых запросов к Telegram до таймаута OpenRouter
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+_lock = threading.Lock()
+
+
+def _labels_key(labelnames, labels):
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = list(zip(labelnames, key))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        with _lock:
+            _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = _labels_key(self.labelnames, labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_labels_key(self.labelnames, labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with _lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # key -> [счётчики по корзинам..., сумма, количество]
+        self._values = {}
+        with _lock:
+            _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = _labels_key(self.labelnames, labels)
+        with _lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            items = [(key, list(data)) for key, data in self._values.items()]
+        for key, data in items:
+            for bound, count in zip(self.buckets, data):
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', repr(float(bound))))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', '+Inf'))} {data[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {data[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {data[-1]}")
+        return lines
+
+
+class Gauge:
+    """Значение читается функцией в момент выгрузки метрик"""
+
+    def __init__(self, name, documentation, func):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        with _lock:
+            _registry.append(self)
+
+    def render(self):
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        if value is None:
+            # Значения ещё нет (например, не было ни одного обновления)
+            return []
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    with _lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# === МЕТРИКИ БОТА ===
+stage_seconds = Histogram("bot_stage_seconds", "Duration of webhook pipeline stages", ["stage"])
+stage_errors = Counter("bot_stage_errors_total", "Pipeline stages that raised an exception", ["stage"])
+http_seconds = Histogram("bot_http_request_seconds", "Outbound HTTP request duration per attempt",
+                         ["target", "endpoint", "status"])
+updates_total = Counter("bot_updates_total", "Handled Telegram updates", ["kind"])
+coalesced_updates = Counter("bot_coalesced_updates_total", "Updates merged into an earlier one of the same batch")
+duplicate_updates = Counter("bot_duplicate_updates_total", "Re-delivered updates skipped by update_id")
+shed_updates = Counter("bot_shed_updates_total", "Updates not answered because of overload", ["reason"])
+formatting_fallbacks = Counter("bot_formatting_fallbacks_total", "Reply parts resent as plain text after markup was rejected")
+openrouter_tokens = Counter("bot_openrouter_tokens_total", "OpenRouter token usage from the usage field", ["type"])
+
+
+def _process_start():
+    """Время запуска процесса по time.time(): на Linux - из /proc, иначе - импорт этого модуля"""
+    try:
+        with open("/proc/self/stat") as f:
+            # starttime - 22-е поле, в тиках с загрузки системы; имя процесса в скобках может содержать пробелы
+            ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        age = time.clock_gettime(time.CLOCK_BOOTTIME) - ticks / os.sysconf("SC_CLK_TCK")
+        return time.time() - max(age, 0)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.time()
+
+
+# === ХОЛОДНЫЙ СТАРТ ===
+process_start = _process_start()
+startup = {"first_update": None, "warmup": None}  # Секунды от запуска процесса
+
+
+def mark_startup(event):
+    """Запомнить, через сколько секунд после запуска процесса случилось событие (один раз)"""
+    if startup[event] is None:
+        startup[event] = round(time.time() - process_start, 3)
+
+
+Gauge("bot_first_update_seconds", "Seconds from process start to the first handled update",
+      lambda: startup["first_update"])
+Gauge("bot_warmup_seconds", "Seconds from process start to the end of background warm-up",
+      lambda: startup["warmup"])
+
+
+@contextmanager
+def span(stage):
+    """Замер длительности этапа обработки"""
+    start = time.monotonic()
+    try:
+        yield
+    except Exception:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        stage_seconds.observe(time.monotonic() - start, stage=stage)
+
+
+def record_usage(usage):
+    """Учесть поле usage из ответа OpenRouter"""
+    if not usage:
+        return
+    for field, name in (("prompt_tokens", "prompt"), ("completion_tokens", "completion")):
+        if usage.get(field):
+            openrouter_tokens.inc(usage[field], type=name)
+    # Входные токены, прочитанные из кэша промптов провайдера
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    if usage.get("prompt_tokens"):
+        openrouter_tokens.inc(cached, type="prompt_cached")
+        openrouter_tokens.inc(usage["prompt_tokens"] - cached, type="prompt_uncached")
@@ -0,0 +1,306 @@
+"""
+Выбор модели OpenRouter для запроса.
+По каждой модели копится скользящая статистика задержек и ошибок: первой пробуется
+самая быстрая исправная модель, при долгом ответе (дольше перцентиля обычной задержки)
+параллельно уходит страхующий запрос, проигравший отменяется.
+Модель, которая подряд отвечает ошибками, временно выводится из ротации.
+После дедлайна запроса все попытки отменяются. Если все потоки заняты попытками,
+страхующий запрос не отправляется - он только отнял бы поток у следующих запросов.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# === КОНФИГУРАЦИЯ ===
+ROUTER_WINDOW = int(os.environ.get("ROUTER_WINDOW", 50))  # Последних запросов в статистике модели
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", 0.95))
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", 2))  # Раньше страховать нет смысла
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", 10))  # Пока статистики нет
+HEDGE_MIN_SAMPLES = 10
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 5))  # Ошибок подряд до отключения модели
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", 30))  # Секунды вне ротации
+ROUTER_THREADS = int(os.environ.get("ROUTER_THREADS", 16))
+
+model_requests = metrics.Counter("bot_model_requests_total", "Model attempts by outcome", ["model", "outcome"])
+model_hedges = metrics.Counter("bot_model_hedges_total", "Hedged second requests", ["model"])
+breaker_trips = metrics.Counter("bot_model_breaker_trips_total", "Models taken out of rotation", ["model"])
+
+_executor = ThreadPoolExecutor(max_workers=ROUTER_THREADS, thread_name_prefix="model")
+_in_flight = 0  # Попыток в работе во всех пулах
+_in_flight_lock = threading.Lock()
+
+
+def _submit(request, model, attempt):
+    global _in_flight
+    with _in_flight_lock:
+        _in_flight += 1
+    future = _executor.submit(request, model, attempt)
+    future.add_done_callback(_attempt_done)
+    return future
+
+
+def _attempt_done(future):
+    global _in_flight
+    with _in_flight_lock:
+        _in_flight -= 1
+
+
+def _saturated():
+    """Свободного потока для ещё одной попытки нет"""
+    with _in_flight_lock:
+        return _in_flight >= ROUTER_THREADS
+
+
+def _when_done(futures, callback):
+    """callback() - когда закончатся все futures (сразу, если их нет)"""
+    if not futures:
+        callback()
+        return
+    left = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            left[0] -= 1
+            last = not left[0]
+        if last:
+            callback()
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+class ModelStats:
+    """Скользящие задержки и ошибки модели, состояние предохранителя"""
+
+    def __init__(self, window=ROUTER_WINDOW):
+        # Задержки отдельно для потоковых (до первого куска) и обычных ответов
+        self.latencies = {True: deque(maxlen=window), False: deque(maxlen=window)}
+        self.outcomes = deque(maxlen=window)
+        self.failures = 0
+        self.open_until = 0
+
+    def percentile(self, q, streaming):
+        values = sorted(self.latencies[streaming])
+        if len(values) < HEDGE_MIN_SAMPLES:
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0
+
+
+class _Call:
+    """Общее состояние попыток одного запроса"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.winner = None
+        self.attempts = []
+
+
+class Attempt:
+    """Одна попытка запроса к модели. claim() - занять ответ (для стрима - перед первым куском)"""
+
+    def __init__(self, router, call, model, streaming, deadline=None):
+        self.call = call
+        self.model = model
+        self.streaming = streaming
+        self.deadline = deadline
+        self.cancelled = threading.Event()
+        self.started = time.monotonic()
+        self.first_response = None
+        self._router = router
+
+    def claim(self):
+        if self.first_response is None:
+            self.first_response = time.monotonic() - self.started
+        return self._router._claim(self)
+
+    def timeout(self, limit):
+        """Таймаут HTTP-запроса: не дольше limit и не позже дедлайна"""
+        if self.deadline is None:
+            return limit
+        return max(0.1, min(limit, self.deadline - time.time()))
+
+
+class ModelRouter:
+    """Пул моделей одной возможности (текст или картинки)"""
+
+    def __init__(self, name, models):
+        self.name = name
+        self.models = list(models)
+        self._lock = threading.Lock()
+        self._stats = {model: ModelStats() for model in self.models}
+
+    def candidates(self):
+        """Модели по порядку предпочтения: исправные и быстрые первыми"""
+        now = time.monotonic()
+        with self._lock:
+            ranked = sorted(
+                self.models,
+                key=lambda m: (self._stats[m].error_rate() >= 0.5,
+                               self._stats[m].percentile(0.5, False) or 0,
+                               self.models.index(m)),
+            )
+            available = [m for m in ranked if self._stats[m].open_until <= now]
+        # Все модели отключены - пробуем ту, что отключена раньше всех, а не отказываем сразу
+        return available or sorted(ranked, key=lambda m: self._stats[m].open_until)[:1]
+
+    def hedge_delay(self, model, streaming):
+        with self._lock:
+            value = self._stats[model].percentile(HEDGE_PERCENTILE, streaming)
+        return max(HEDGE_MIN_DELAY, value if value is not None else HEDGE_DEFAULT_DELAY)
+
+    def call(self, request, streaming=False, deadline=None, on_settled=None):
+        """
+        request(model, attempt) -> ответ или None.
+        Возвращает первый успешный ответ; страхующий запрос уходит на следующую модель
+        (или ту же, если она одна), если первая не ответила за hedge_delay.
+        deadline (по time.time()) - позже ответ не нужен: попытки отменяются, возвращается None.
+        on_settled() вызывается, когда закончатся все попытки, в том числе проигравшие
+        после возврата ответа (например, чтобы освободить слот допуска).
+        """
+        pending = {}
+        try:
+            return self._call(request, streaming, deadline, pending)
+        finally:
+            if on_settled is not None:
+                _when_done(list(pending), on_settled)
+
+    def _call(self, request, streaming, deadline, pending):
+        """Попытки запроса; pending - future -> попытка, ещё не закончившиеся к возврату"""
+        candidates = self.candidates()
+        call = _Call()
+        queue = list(candidates)
+
+        def launch():
+            model = queue.pop(0) if queue else candidates[0]
+            attempt = Attempt(self, call, model, streaming, deadline)
+            with call.lock:
+                call.attempts.append(attempt)
+                # Ответ уже занят (поток пошёл) - попытка заранее проигравшая
+                if call.winner is not None:
+                    attempt.cancelled.set()
+            pending[_submit(request, model, attempt)] = attempt
+            return attempt
+
+        primary = launch()
+        hedge_at = time.monotonic() + self.hedge_delay(primary.model, streaming)
+        hedged = False
+
+        while pending:
+            timeout = None if hedged else max(0, hedge_at - time.monotonic())
+            if deadline is not None:
+                remaining = max(0, deadline - time.time())
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                attempt = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"Model {attempt.model} request error: {e}")
+                    result = None
+                won = result is not None and attempt.claim()
+                self._record(attempt, result is not None)
+                if won:
+                    # Проигравшие досчитываем в статистику, когда закончатся
+                    for other_future, other in pending.items():
+                        other_future.add_done_callback(lambda f, a=other: self._record_late(f, a))
+                    return result
+                if result is None and not attempt.cancelled.is_set() and not hedged and not pending:
+                    # Ошибка до страховки - сразу пробуем следующую модель
+                    if queue:
+                        launch()
+                        hedged = True
+
+            if deadline is not None and pending and time.time() >= deadline:
+                # Ответ уже не нужен - отменённые попытки закрывают соединения и не занимают потоки
+                for other_future, other in pending.items():
+                    other.cancelled.set()
+                    other_future.add_done_callback(lambda f, a=other: self._record_late(f, a))
+                logger.warning(f"{self.name} request cancelled at deadline")
+                return None
+
+            if not hedged and pending and time.monotonic() >= hedge_at:
+                hedged = True
+                if call.winner is not None:
+                    # Стрим уже отдаёт куски - страховать нечего
+                    continue
+                if _saturated():
+                    logger.info(f"Not hedging {self.name} request: all model threads are busy")
+                    continue
+                attempt = launch()
+                model_hedges.inc(model=attempt.model)
+                logger.info(f"Hedging {self.name} request to {attempt.model}")
+
+        return None
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                model: {
+                    "p50": s.percentile(0.5, False),
+                    "p95": s.percentile(0.95, False),
+                    "stream_p50": s.percentile(0.5, True),
+                    "error_rate": round(s.error_rate(), 3),
+                    "open": s.open_until > now,
+                }
+                for model, s in self._stats.items()
+            }
+
+    # --- внутреннее ---
+
+    def _claim(self, attempt):
+        """Первая попытка, занявшая ответ, побеждает; остальные отменяются"""
+        call = attempt.call
+        with call.lock:
+            if call.winner is None:
+                call.winner = attempt
+                for other in call.attempts:
+                    if other is not attempt:
+                        other.cancelled.set()
+            return call.winner is attempt
+
+    def _record_late(self, future, attempt):
+        try:
+            ok = future.result() is not None
+        except Exception:
+            ok = False
+        self._record(attempt, ok)
+
+    def _record(self, attempt, ok):
+        if attempt.cancelled.is_set() and not ok:
+            # Проигравший - не ошибка модели, но он был медленнее как минимум на это время
+            model_requests.inc(model=attempt.model, outcome="cancelled")
+            with self._lock:
+                self._stats[attempt.model].latencies[attempt.streaming].append(time.monotonic() - attempt.started)
+            return
+        model_requests.inc(model=attempt.model, outcome="ok" if ok else "error")
+        now = time.monotonic()
+        with self._lock:
+            stats = self._stats[attempt.model]
+            stats.outcomes.append(ok)
+            if ok:
+                latency = attempt.first_response if attempt.first_response is not None else now - attempt.started
+                stats.latencies[attempt.streaming].append(latency)
+                stats.failures = 0
+                stats.open_until = 0
+                return
+            stats.failures += 1
+            if stats.failures >= BREAKER_FAILURES:
+                if stats.open_until <= now:
+                    breaker_trips.inc(model=attempt.model)
+                    logger.warning(f"Model {attempt.model} taken out of rotation for {BREAKER_COOLDOWN}s")
+                stats.open_until = now + BREAKER_COOLDOWN
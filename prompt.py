@@ -0,0 +1,68 @@
+"""
+Сборка запроса к модели.
+Системный промпт и история идут неизменным префиксом (байт в байт от запроса к запросу),
+чтобы кэш промптов на стороне провайдера попадал. JSON сообщений истории
+сериализуется один раз и переиспользуется.
+"""
+
+import os
+import json
+from functools import lru_cache
+
+# === КОНФИГУРАЦИЯ ===
+PROMPT_CACHE_CONTROL = os.environ.get("PROMPT_CACHE_CONTROL", "auto")  # auto | on | off
+# Провайдеры, которым нужна явная разметка cache_control (у остальных кэш автоматический)
+CACHE_CONTROL_PREFIXES = ("anthropic/", "google/gemini")
+FRAGMENT_CACHE_SIZE = int(os.environ.get("PROMPT_FRAGMENT_CACHE", 4096))
+
+SYSTEM_PROMPT = """Ты полезный ассистент. Отвечай на русском языке. Помни историю диалога.
+
+Если пользователь просит картинку, изображение, фото, рисунок или что-то визуальное:
+1. Ты МОЖЕШЬ генерировать/создавать изображения
+2. Для этого используй специальный формат:
+   [IMAGE:URL_ЗДЕСЬ]
+   Например: [IMAGE:https://example.com/image.jpg]
+3. Можешь добавить описание после URL, разделяя вертикальной чертой: [IMAGE:https://example.com/image.jpg|Описание изображения]
+4. Если не можешь или не нужно генерировать изображение - просто ответь текстом."""
+
+
+def build_messages(history, content, system_prompt=SYSTEM_PROMPT):
+    """Системный промпт, история и новое сообщение пользователя (текст или список частей)"""
+    return [{"role": "system", "content": system_prompt}, *history, {"role": "user", "content": content}]
+
+
+def wants_cache_control(model):
+    if PROMPT_CACHE_CONTROL == "auto":
+        return model.startswith(CACHE_CONTROL_PREFIXES)
+    return PROMPT_CACHE_CONTROL == "on"
+
+
+@lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
+def _text_message(role, content, cache_hint):
+    if cache_hint:
+        message = {"role": role, "content": [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]}
+    else:
+        message = {"role": role, "content": content}
+    return json.dumps(message, ensure_ascii=False)
+
+
+def message_json(message, cache_hint=False):
+    """JSON одного сообщения; текстовые сообщения берутся из кэша фрагментов"""
+    if isinstance(message["content"], str):
+        return _text_message(message["role"], message["content"], cache_hint)
+    return json.dumps(message, ensure_ascii=False)
+
+
+def serialize_request(model, data):
+    """
+    Тело запроса к OpenRouter. data - {"messages": [...], остальные поля}.
+    Метки cache_control ставятся на системный промпт и на конец истории -
+    границы префикса, который повторится в следующем запросе.
+    """
+    messages = data["messages"]
+    hint = wants_cache_control(model)
+    last_prefix = len(messages) - 2
+    fragments = [message_json(m, cache_hint=hint and i in (0, last_prefix)) for i, m in enumerate(messages)]
+    fields = "".join(f", {json.dumps(k)}: {json.dumps(v, ensure_ascii=False)}"
+                     for k, v in data.items() if k != "messages")
+    return f'{{"model": {json.dumps(model)}, "messages": [{", ".join(fragments)}]{fields}}}'
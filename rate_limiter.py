@@ -0,0 +1,273 @@
+"""
+Планировщик исходящих запросов к Telegram.
+Глобальный и поканальные token bucket, приоритеты (ответы важнее статусов "печатает"),
+учёт retry_after и выбрасывание устаревших chat action. Статусы и промежуточные правки
+ставятся без ожидания, и из ожидающих остаётся только последний на чат.
+"""
+
+import os
+import time
+import logging
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# === КОНФИГУРАЦИЯ ===
+# Лимиты Telegram: ~30 сообщений/с всего, ~1/с в личный чат, 20/мин в группу
+GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", 30))
+GLOBAL_BURST = float(os.environ.get("TG_GLOBAL_BURST", 30))
+CHAT_RATE = float(os.environ.get("TG_CHAT_RATE", 1))
+CHAT_BURST = float(os.environ.get("TG_CHAT_BURST", 3))
+GROUP_RATE = float(os.environ.get("TG_GROUP_RATE", 20 / 60))
+GROUP_BURST = float(os.environ.get("TG_GROUP_BURST", 3))
+ACTION_TTL = float(os.environ.get("TG_ACTION_TTL", 5))  # Статус "печатает" старше этого не нужен
+MAX_ATTEMPTS = int(os.environ.get("TG_MAX_ATTEMPTS", 3))  # Попыток при 429
+
+# Приоритеты: меньше - важнее
+PRIORITY_REPLY = 0
+PRIORITY_EDIT = 1
+PRIORITY_ACTION = 2
+
+
+class TokenBucket:
+    """Token bucket с возможностью заблокировать отправку до момента (retry_after)"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Через сколько секунд появится токен (0 - уже есть)"""
+        self._refill(now)
+        wait = max(0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class _Ticket:
+    __slots__ = ("priority", "seq", "chat_id", "enqueued", "granted", "event", "fn")
+
+    def __init__(self, priority, seq, chat_id, fn=None):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.event = threading.Event()
+        self.fn = fn
+
+
+def is_rate_limited(response):
+    return response is not None and getattr(response, "status_code", None) == 429
+
+
+def retry_after(response):
+    try:
+        return float(response.json()["parameters"]["retry_after"])
+    except Exception:
+        return 1.0
+
+
+class OutboundScheduler:
+    """Очередь исходящих запросов с приоритетами и ограничением скорости"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._chats = {}
+        self._queue = []
+        # (приоритет, chat_id) -> ожидающий запрос без ожидания (оставляем только последний)
+        self._latest = {}
+        self._seq = itertools.count()
+        self._last_prune = time.monotonic()
+        self._background_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tg-background")
+
+        # Статистика
+        self.granted = 0
+        self.rate_limited = 0
+        self.dropped_actions = 0
+        self.dropped_edits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        threading.Thread(target=self._loop, name="tg-scheduler", daemon=True).start()
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Отрицательные chat_id - группы и каналы
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(GROUP_RATE, GROUP_BURST)
+            else:
+                bucket = TokenBucket(CHAT_RATE, CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    # --- API ---
+
+    def call(self, chat_id, fn, priority=PRIORITY_REPLY, timeout=60):
+        """
+        Выполнить fn() (запрос к Telegram), когда лимиты позволят.
+        На 429 блокируем чат на retry_after и повторяем. Возвращает результат fn.
+        """
+        deadline = time.monotonic() + timeout
+        for attempt in range(MAX_ATTEMPTS):
+            if not self._acquire(chat_id, priority, deadline - time.monotonic()):
+                raise TimeoutError(f"Outbound queue timeout for chat {chat_id}")
+            response = fn()
+            if not is_rate_limited(response) or attempt == MAX_ATTEMPTS - 1:
+                return response
+            self._on_rate_limited(chat_id, retry_after(response))
+        return response
+
+    def submit_action(self, chat_id, fn):
+        """Поставить chat action без ожидания. Старый ожидающий action этого чата заменяется"""
+        self.submit_latest(chat_id, fn, PRIORITY_ACTION)
+
+    def submit_latest(self, chat_id, fn, priority=PRIORITY_EDIT):
+        """
+        Поставить запрос без ожидания: fn() выполнится в фоне, когда лимиты позволят.
+        Ожидающий запрос того же чата и приоритета заменяется - промежуточные правки
+        и статусы нужны только последние. На 429 fn() не повторяется, чат блокируется
+        """
+        with self._cond:
+            self._drop_latest(chat_id, priority)
+            ticket = _Ticket(priority, next(self._seq), chat_id, fn)
+            self._latest[(priority, chat_id)] = ticket
+            self._queue.append(ticket)
+            self._cond.notify()
+
+    def cancel_latest(self, chat_id, priority=PRIORITY_EDIT):
+        """Убрать ещё не отправленный запрос из submit_latest"""
+        with self._cond:
+            self._drop_latest(chat_id, priority)
+
+    def stats(self):
+        with self._cond:
+            depth = {}
+            for ticket in self._queue:
+                depth[ticket.priority] = depth.get(ticket.priority, 0) + 1
+            oldest = min((t.enqueued for t in self._queue), default=None)
+            return {
+                "queue_depth": len(self._queue),
+                "queue_depth_by_priority": depth,
+                "oldest_wait": time.monotonic() - oldest if oldest else 0.0,
+                "granted": self.granted,
+                "avg_wait": self.total_wait / self.granted if self.granted else 0.0,
+                "max_wait": self.max_wait,
+                "rate_limited": self.rate_limited,
+                "dropped_actions": self.dropped_actions,
+                "dropped_edits": self.dropped_edits,
+            }
+
+    # --- внутреннее ---
+
+    def _drop_latest(self, chat_id, priority):
+        ticket = self._latest.pop((priority, chat_id), None)
+        if ticket is None:
+            return
+        self._queue.remove(ticket)
+        if priority == PRIORITY_ACTION:
+            self.dropped_actions += 1
+        else:
+            self.dropped_edits += 1
+
+    def _acquire(self, chat_id, priority, timeout):
+        with self._cond:
+            ticket = _Ticket(priority, next(self._seq), chat_id)
+            self._queue.append(ticket)
+            self._cond.notify()
+        if ticket.event.wait(max(timeout, 0)):
+            return True
+        with self._cond:
+            if ticket.granted:
+                return True
+            self._queue.remove(ticket)
+            return False
+
+    def _on_rate_limited(self, chat_id, seconds):
+        logger.warning(f"Telegram 429 for chat {chat_id}, retry after {seconds}s")
+        with self._cond:
+            self.rate_limited += 1
+            self._bucket(chat_id).block(seconds)
+            self._cond.notify()
+
+    def _grant(self, ticket, now):
+        self._queue.remove(ticket)
+        self._global.take(now)
+        self._bucket(ticket.chat_id).take(now)
+        waited = now - ticket.enqueued
+        self.granted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        ticket.granted = True
+        if ticket.fn is not None:
+            self._latest.pop((ticket.priority, ticket.chat_id), None)
+            self._background_executor.submit(self._run_background, ticket)
+        else:
+            ticket.event.set()
+
+    def _run_background(self, ticket):
+        try:
+            response = ticket.fn()
+        except Exception as e:
+            logger.debug(f"Background Telegram request error: {e}")
+            return
+        if is_rate_limited(response):
+            self._on_rate_limited(ticket.chat_id, retry_after(response))
+
+    def _prune(self, now):
+        """Забыть чаты, чьи buckets полны и не заблокированы - они ничем не отличаются от новых"""
+        waiting = {t.chat_id for t in self._queue}
+        for chat_id, bucket in list(self._chats.items()):
+            if chat_id not in waiting and bucket.wait_time(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self._chats[chat_id]
+        self._last_prune = now
+
+    def _loop(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if now - self._last_prune > 60:
+                    self._prune(now)
+
+                # Устаревшие статусы "печатает" уже бесполезны
+                for ticket in [t for t in self._queue
+                               if t.priority == PRIORITY_ACTION and t.fn is not None and now - t.enqueued > ACTION_TTL]:
+                    self._drop_latest(ticket.chat_id, PRIORITY_ACTION)
+
+                sleep = None
+                global_wait = self._global.wait_time(now)
+                if global_wait == 0:
+                    for ticket in sorted(self._queue, key=lambda t: (t.priority, t.seq)):
+                        wait = self._bucket(ticket.chat_id).wait_time(now)
+                        if wait == 0:
+                            self._grant(ticket, now)
+                            sleep = 0
+                            break
+                        sleep = wait if sleep is None else min(sleep, wait)
+                elif self._queue:
+                    sleep = global_wait
+
+                if sleep == 0:
+                    continue
+                if any(priority == PRIORITY_ACTION for priority, _ in self._latest):
+                    sleep = min(sleep or ACTION_TTL, ACTION_TTL)
+                self._cond.wait(sleep)
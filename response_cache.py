@@ -0,0 +1,160 @@
+"""
+Кэш ответов модели по точному совпадению запроса.
+Ключ - хэш от пула моделей, нормализованных сообщений, хэшей картинок и max_tokens.
+Хранится уже разобранный ответ (текст без тегов и список картинок).
+При остановке кэш сохраняется на диск и восстанавливается при следующем запуске.
+"""
+
+import os
+import json
+import time
+import atexit
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# === КОНФИГУРАЦИЯ ===
+RESPONSE_CACHE_ENTRIES = int(os.environ.get("RESPONSE_CACHE_ENTRIES", 1000))
+RESPONSE_CACHE_BYTES = int(os.environ.get("RESPONSE_CACHE_BYTES", 8 * 1024 * 1024))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 3600))  # 0 - кэш выключен
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH",
+                                     os.path.join(os.environ.get("BOT_DATA_DIR", "data"), "response_cache.json"))
+
+lookups = metrics.Counter("bot_response_cache_total", "Response cache lookups", ["result"])
+
+
+def _normalize(content):
+    """Текст без лишних пробелов, data: URL картинок заменяются их хэшем"""
+    if isinstance(content, str):
+        return " ".join(content.split())
+    if isinstance(content, list):
+        parts = []
+        for part in content:
+            if part.get("type") == "image_url":
+                url = part["image_url"]["url"]
+                if url.startswith("data:"):
+                    url = "sha256:" + hashlib.sha256(url.encode("ascii")).hexdigest()
+                parts.append({"type": "image_url", "url": url})
+            else:
+                parts.append({"type": part.get("type"), "text": _normalize(part.get("text", ""))})
+        return parts
+    return content
+
+
+def _size_of(value):
+    return len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+
+class ResponseCache:
+    """LRU кэш с TTL и ограничением по числу записей и памяти"""
+
+    def __init__(self, max_entries=RESPONSE_CACHE_ENTRIES, max_bytes=RESPONSE_CACHE_BYTES, ttl=RESPONSE_CACHE_TTL,
+                 path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path  # Файл снимка; None - только в памяти
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, size, expires)
+        self._size = 0
+        if path and ttl > 0:
+            atexit.register(self.save)
+
+    @staticmethod
+    def key(models, messages, max_tokens, image_hashes=()):
+        """Стабильный ключ запроса. image_hashes - хэши картинок, если их нет в messages"""
+        payload = {
+            "models": list(models),
+            "messages": [{"role": m["role"], "content": _normalize(m["content"])} for m in messages],
+            "images": list(image_hashes),
+            "max_tokens": max_tokens,
+        }
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if self.ttl <= 0:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] > now:
+                self._entries.move_to_end(key)
+                lookups.inc(result="hit")
+                return entry[0]
+            if entry is not None:
+                self._drop(key)
+        lookups.inc(result="miss")
+        return None
+
+    def put(self, key, value):
+        if self.ttl <= 0:
+            return
+        self._store(key, value, time.monotonic() + self.ttl)
+
+    def save(self):
+        """Снимок живых записей на диск (от давних к свежим, с оставшимся TTL)"""
+        if not self.path:
+            return
+        now = time.monotonic()
+        with self._lock:
+            entries = [[key, value, expires - now] for key, (value, _, expires) in self._entries.items()
+                       if expires > now]
+        tmp_path = f"{self.path}.tmp"
+        try:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Response cache save error: {e}")
+
+    def load(self):
+        """Восстановить снимок после запуска. Возвращает число записей"""
+        if not self.path or self.ttl <= 0:
+            return 0
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            logger.warning(f"Response cache snapshot ignored: {e}")
+            return 0
+        now = time.monotonic()
+        loaded = 0
+        for key, value, remaining in entries:
+            if remaining > 0:
+                # Свежие записи того же процесса не затираем старым снимком
+                with self._lock:
+                    if key in self._entries:
+                        continue
+                self._store(key, value, now + min(remaining, self.ttl))
+                loaded += 1
+        return loaded
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size,
+                    "hits": lookups.value(result="hit"), "misses": lookups.value(result="miss")}
+
+    def _store(self, key, value, expires):
+        size = _size_of(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (value, size, expires)
+            self._size += size
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
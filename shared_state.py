@@ -0,0 +1,216 @@
+"""
+Общее состояние для нескольких процессов (gunicorn workers).
+Обновления пишутся в общую очередь в SQLite и разбиты на шарды по chat_id.
+Каждый процесс арендует часть шардов и обрабатывает только свои чаты -
+порядок внутри чата, лимиты Telegram на чат и локальность кэшей сохраняются.
+История в группе ведётся отдельно для каждого чата (history_store.history_key),
+поэтому её тоже ведёт процесс-владелец чата.
+"""
+
+import os
+import json
+import math
+import time
+import uuid
+import sqlite3
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# === КОНФИГУРАЦИЯ ===
+DATA_DIR = os.environ.get("BOT_DATA_DIR", "data")
+SHARED_DB_PATH = os.environ.get("SHARED_DB_PATH", os.path.join(DATA_DIR, "shared.db"))
+SHARDS = int(os.environ.get("BOT_SHARDS", 16))
+LEASE_TTL = float(os.environ.get("SHARD_LEASE_TTL", 15))  # Секунды без продления - шард свободен
+HEARTBEAT_INTERVAL = float(os.environ.get("SHARD_HEARTBEAT_INTERVAL", 3))
+POLL_INTERVAL = float(os.environ.get("SHARED_POLL_INTERVAL", 0.05))
+
+
+def shard_for(chat_id, shards=SHARDS):
+    """Jump consistent hash: при изменении числа шардов переезжает минимум чатов"""
+    key = int.from_bytes(hashlib.blake2b(str(chat_id).encode(), digest_size=8).digest(), "big")
+    b, j = -1, 0
+    while j < shards:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+class SharedUpdateQueue:
+    """Очередь обновлений и аренда шардов в общей базе SQLite"""
+
+    def __init__(self, path=SHARED_DB_PATH, shards=SHARDS):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.shards = shards
+        self._lock = threading.Lock()
+        # Несколько процессов пишут в одну базу - ждём блокировку, а не падаем
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS updates ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, shard INTEGER NOT NULL,"
+            " chat_id INTEGER NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS updates_shard ON updates (shard, id);"
+            "CREATE TABLE IF NOT EXISTS leases (shard INTEGER PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS workers (owner TEXT PRIMARY KEY, expires REAL NOT NULL);"
+        )
+
+    def put(self, chat_id, update):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO updates (shard, chat_id, payload, created) VALUES (?, ?, ?, ?)",
+                (shard_for(chat_id, self.shards), chat_id, json.dumps(update, ensure_ascii=False), time.time()),
+            )
+
+    def fetch(self, shards, limit=200):
+        """Необработанные обновления своих шардов по порядку поступления"""
+        if not shards:
+            return []
+        marks = ",".join("?" * len(shards))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, shard, chat_id, payload FROM updates WHERE shard IN ({marks}) ORDER BY id LIMIT ?",
+                (*shards, limit),
+            ).fetchall()
+        return [(row_id, shard, chat_id, json.loads(payload)) for row_id, shard, chat_id, payload in rows]
+
+    def ack(self, row_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM updates WHERE id = ?", (row_id,))
+
+    def heartbeat(self, owner, busy_shards=()):
+        """
+        Продлить аренду своих шардов и привести их число к честной доле.
+        Лишние шарды отдаём, только если по ним ничего не обрабатывается.
+        Возвращает множество шардов этого процесса.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("INSERT OR REPLACE INTO workers (owner, expires) VALUES (?, ?)",
+                                   (owner, now + LEASE_TTL))
+                self._conn.execute("DELETE FROM workers WHERE expires < ?", (now,))
+                live = self._conn.execute("SELECT COUNT(*) FROM workers").fetchone()[0]
+                target = math.ceil(self.shards / max(live, 1))
+
+                self._conn.execute("UPDATE leases SET expires = ? WHERE owner = ?", (now + LEASE_TTL, owner))
+                mine = {row[0] for row in self._conn.execute(
+                    "SELECT shard FROM leases WHERE owner = ?", (owner,))}
+
+                for shard in sorted(mine - set(busy_shards)):
+                    if len(mine) <= target:
+                        break
+                    self._conn.execute("DELETE FROM leases WHERE shard = ? AND owner = ?", (shard, owner))
+                    mine.discard(shard)
+
+                if len(mine) < target:
+                    taken = {row[0] for row in self._conn.execute(
+                        "SELECT shard FROM leases WHERE expires >= ?", (now,))}
+                    for shard in range(self.shards):
+                        if len(mine) >= target:
+                            break
+                        if shard not in taken:
+                            self._conn.execute(
+                                "INSERT OR REPLACE INTO leases (shard, owner, expires) VALUES (?, ?, ?)",
+                                (shard, owner, now + LEASE_TTL))
+                            mine.add(shard)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return mine
+
+    def release(self, owner):
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE owner = ?", (owner,))
+            self._conn.execute("DELETE FROM workers WHERE owner = ?", (owner,))
+
+    def depth(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM updates").fetchone()[0]
+
+
+class ShardConsumer:
+    """
+    Фоновый поток процесса: арендует шарды, забирает их обновления из общей очереди
+    и передаёт в submit(chat_id, update, ack). ack() удаляет обновление из очереди -
+    если процесс упадёт раньше, обновление достанется новому владельцу шарда.
+    on_rebalance(changed) вызывается при смене набора шардов - сбросить кэши этих чатов.
+    """
+
+    def __init__(self, queue, submit, on_rebalance=None):
+        self.queue = queue
+        self.submit = submit
+        self.on_rebalance = on_rebalance
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.shards = set()
+        self._lock = threading.Lock()
+        self._handed = {}  # row_id -> shard, переданные в обработку
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="shard-consumer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=5)
+        self.queue.release(self.owner)
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._handed)
+        return {"owner": self.owner, "shards": sorted(self.shards), "in_flight": in_flight,
+                "queue_depth": self.queue.depth()}
+
+    def wake(self):
+        """Новое обновление в очереди - не ждать следующего опроса"""
+        self._wake.set()
+
+    def _ack(self, row_id):
+        try:
+            self.queue.ack(row_id)
+        finally:
+            with self._lock:
+                self._handed.pop(row_id, None)
+
+    def _loop(self):
+        next_heartbeat = 0
+        while not self._stop.is_set():
+            try:
+                if time.monotonic() >= next_heartbeat:
+                    with self._lock:
+                        busy = set(self._handed.values())
+                    shards = self.queue.heartbeat(self.owner, busy)
+                    if shards != self.shards:
+                        logger.info(f"Worker {self.owner} owns shards {sorted(shards)}")
+                        changed = shards ^ self.shards
+                        self.shards = shards
+                        if self.on_rebalance:
+                            self.on_rebalance(changed)
+                    next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+
+                for row_id, shard, chat_id, update in self.queue.fetch(sorted(self.shards)):
+                    with self._lock:
+                        if row_id in self._handed:
+                            continue
+                        self._handed[row_id] = shard
+                    if not self.submit(chat_id, update, lambda row_id=row_id: self._ack(row_id)):
+                        # Локальная очередь переполнена - заберём позже, порядок сохранится
+                        with self._lock:
+                            self._handed.pop(row_id, None)
+                        break
+            except Exception as e:
+                logger.error(f"Shard consumer error: {e}")
+
+            self._wake.wait(POLL_INTERVAL)
+            self._wake.clear()
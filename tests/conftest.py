@@ -0,0 +1,22 @@
+"""
+Общее для тестов: модули бота импортируются из корня репозитория,
+а пути к данным по умолчанию (они вычисляются при импорте модулей) ведут
+во временный каталог, а не в data/ рабочей копии.
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["BOT_DATA_DIR"] = tempfile.mkdtemp(prefix="bot-test-")
+os.environ["BOT_WARMUP"] = "0"
+
+
+def wait_until(predicate, timeout=5):
+    """Дождаться условия, которое выполнит другой поток"""
+    end = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < end, "condition not reached"
+        time.sleep(0.005)
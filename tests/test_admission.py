@@ -0,0 +1,130 @@
+"""
+Допуск запросов к модели: лимиты, очередь ожидания, приоритет пользователей
+перед фоновыми запросами.
+"""
+
+import time
+import threading
+
+import pytest
+
+from admission import AdmissionController, Overloaded
+from conftest import wait_until
+
+
+class Holder:
+    """Поток, который занимает слот и держит его до release()"""
+
+    def __init__(self, controller, name, user_id, order, background=False, deadline=None):
+        self.name = name
+        self.error = None
+        self._done = threading.Event()
+
+        def run():
+            try:
+                with controller.slot(user_id, deadline, background=background):
+                    order.append(name)
+                    self._done.wait(5)
+            except Overloaded as e:
+                self.error = e
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def release(self):
+        self._done.set()
+        self.thread.join(5)
+
+
+def test_user_limit_does_not_block_other_users():
+    controller = AdmissionController(global_limit=3, user_limit=1, queue_size=8)
+    with controller.slot(1):
+        with controller.slot(2):
+            assert controller.stats()["active"] == 2
+        with pytest.raises(Overloaded) as error:
+            with controller.slot(1, deadline=time.time() + 0.05):
+                pass
+        assert error.value.reason == "expired"
+    assert controller.stats()["active"] == 0
+
+
+def test_expired_deadline_is_rejected_without_waiting():
+    controller = AdmissionController(global_limit=1)
+    with pytest.raises(Overloaded) as error:
+        with controller.slot(1, deadline=time.time() - 1):
+            pass
+    assert error.value.reason == "expired"
+
+
+def test_full_queue_rejects_as_busy():
+    controller = AdmissionController(global_limit=1, user_limit=1, queue_size=1)
+    order = []
+    with controller.slot(1):
+        waiting = Holder(controller, "b", 2, order)
+        wait_until(lambda: controller.stats()["waiting"] == 1)
+        with pytest.raises(Overloaded) as error:
+            with controller.slot(3):
+                pass
+        assert error.value.reason == "busy"
+    wait_until(lambda: order == ["b"])
+    waiting.release()
+
+
+def test_blocked_user_does_not_hold_up_the_queue():
+    controller = AdmissionController(global_limit=2, user_limit=1, queue_size=8)
+    order = []
+    first = Holder(controller, "a1", 1, order)
+    wait_until(lambda: order == ["a1"])
+    second = Holder(controller, "a2", 1, order)
+    wait_until(lambda: controller.stats()["waiting"] == 1)
+    # Слот свободен, а ждущий упёрся в свой лимит - другой пользователь входит сразу
+    with controller.slot(2):
+        assert order == ["a1"]
+    first.release()
+    wait_until(lambda: order == ["a1", "a2"])
+    second.release()
+
+
+def test_users_go_before_waiting_background_calls():
+    controller = AdmissionController(global_limit=1, user_limit=1, queue_size=8)
+    order = []
+    holder = Holder(controller, "user1", 1, order)
+    wait_until(lambda: order == ["user1"])
+    background = Holder(controller, "summary", 9, order, background=True)
+    wait_until(lambda: controller.stats()["waiting"] == 1)
+    user = Holder(controller, "user2", 2, order)
+    wait_until(lambda: controller.stats()["waiting"] == 2)
+
+    holder.release()
+    wait_until(lambda: len(order) == 2)
+    assert order == ["user1", "user2"]
+    user.release()
+    wait_until(lambda: len(order) == 3)
+    assert order[-1] == "summary"
+    background.release()
+
+
+def test_background_keeps_the_last_slot_for_users():
+    controller = AdmissionController(global_limit=2, user_limit=1, queue_size=8)
+    order = []
+    with controller.slot(1):
+        background = Holder(controller, "summary", 9, order, background=True)
+        wait_until(lambda: controller.stats()["waiting"] == 1)
+        with controller.slot(2):
+            assert order == []
+    wait_until(lambda: order == ["summary"])
+    background.release()
+
+
+def test_background_does_not_count_toward_user_limit():
+    controller = AdmissionController(global_limit=3, user_limit=1, queue_size=8)
+    with controller.slot(1, background=True):
+        with controller.slot(1, deadline=time.time() + 1):
+            assert controller.stats()["active"] == 2
+
+
+def test_notice_due_is_rate_limited_per_chat():
+    controller = AdmissionController()
+    assert controller.notice_due(1)
+    assert not controller.notice_due(1)
+    assert controller.notice_due(2)
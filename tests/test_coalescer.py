@@ -0,0 +1,117 @@
+"""
+Склейка серий сообщений: пачка уходит после окна тишины или при заполнении,
+несклеиваемое задание не обгоняет накопленное, неудачная сдача повторяется.
+"""
+
+import time
+
+from coalescer import Coalescer, message_group_key, RETRY_DELAY
+
+
+class Sink:
+    """Принимает пачки; первые reject сдач отклоняет, как переполненная очередь"""
+
+    def __init__(self, reject=0):
+        self.batches = []
+        self.reject = reject
+
+    def __call__(self, chat_id, jobs):
+        if self.reject:
+            self.reject -= 1
+            return False
+        self.batches.append((chat_id, list(jobs)))
+        return True
+
+
+def key_of(job):
+    """Задания вида (отправитель, текст); отправитель None - команда"""
+    return job[0]
+
+
+def test_burst_is_delivered_as_one_batch():
+    sink = Sink()
+    coalescer = Coalescer(sink, key_of, window=0.05, max_wait=2)
+    for text in ("a", "b", "c"):
+        assert coalescer.submit(1, (7, text))
+    assert coalescer.wait_idle(2)
+    assert sink.batches == [(1, [(7, "a"), (7, "b"), (7, "c")])]
+
+
+def test_full_batch_is_delivered_at_once():
+    sink = Sink()
+    coalescer = Coalescer(sink, key_of, window=10, max_wait=10, max_items=2)
+    coalescer.submit(1, (7, "a"))
+    coalescer.submit(1, (7, "b"))
+    assert sink.batches == [(1, [(7, "a"), (7, "b")])]
+
+
+def test_uncoalesced_job_goes_after_pending_batch():
+    sink = Sink()
+    coalescer = Coalescer(sink, key_of, window=10, max_wait=10)
+    coalescer.submit(1, (7, "a"))
+    coalescer.submit(1, (None, "/help"))
+    assert sink.batches == [(1, [(7, "a")]), (1, [(None, "/help")])]
+
+
+def test_other_sender_starts_a_new_batch():
+    sink = Sink()
+    coalescer = Coalescer(sink, key_of, window=0.3, max_wait=2)
+    coalescer.submit(1, (7, "a"))
+    coalescer.submit(1, (8, "b"))
+    assert sink.batches == [(1, [(7, "a")])]
+    assert coalescer.wait_idle(2)
+    assert sink.batches == [(1, [(7, "a")]), (1, [(8, "b")])]
+
+
+def test_chats_are_batched_separately():
+    sink = Sink()
+    coalescer = Coalescer(sink, key_of, window=0.05, max_wait=2)
+    coalescer.submit(1, (7, "a"))
+    coalescer.submit(2, (7, "b"))
+    assert coalescer.wait_idle(2)
+    assert sorted(sink.batches) == [(1, [(7, "a")]), (2, [(7, "b")])]
+
+
+def test_rejected_batch_is_retried():
+    sink = Sink(reject=1)
+    coalescer = Coalescer(sink, key_of, window=0.01, max_wait=2)
+    started = time.monotonic()
+    coalescer.submit(1, (7, "a"))
+    assert coalescer.wait_idle(RETRY_DELAY + 2)
+    assert sink.batches == [(1, [(7, "a")])]
+    assert time.monotonic() - started >= RETRY_DELAY
+    assert coalescer.stats() == {"chats": 0, "pending": 0}
+
+
+def test_submit_fails_if_pending_batch_cannot_be_delivered():
+    sink = Sink(reject=1)
+    coalescer = Coalescer(sink, key_of, window=10, max_wait=10)
+    assert coalescer.submit(1, (7, "a"))
+    # Накопленное не сдалось - команду не принимаем, чтобы не обогнала пачку
+    assert not coalescer.submit(1, (None, "/help"))
+    assert coalescer.submit(1, (None, "/help"))
+    assert sink.batches == [(1, [(7, "a")]), (1, [(None, "/help")])]
+
+
+def test_pending_limit_rejects_new_jobs():
+    sink = Sink()
+    coalescer = Coalescer(sink, key_of, window=10, max_wait=10, max_pending=1)
+    assert coalescer.submit(1, (7, "a"))
+    assert not coalescer.submit(2, (8, "b"))
+
+
+def message(sender=7, **fields):
+    return {"from": {"id": sender}, "chat": {"id": 1}, **fields}
+
+
+def test_message_group_key_separates_albums_and_kinds():
+    album = message(photo=[{}], media_group_id="A")
+    assert message_group_key(album) == message_group_key(message(photo=[{}], media_group_id="A", caption="x"))
+    # Другой альбом, отдельное фото и текст того же отправителя - разные пачки
+    assert message_group_key(album) != message_group_key(message(photo=[{}], media_group_id="B"))
+    assert message_group_key(message(photo=[{}], caption="x")) is None
+    assert message_group_key(message(text="привет")) == message_group_key(message(text="как дела"))
+    assert message_group_key(message(text="привет")) != message_group_key(message(sender=8, text="привет"))
+    assert message_group_key(message(text="привет")) != message_group_key(album)
+    assert message_group_key(message(text="/help")) is None
+    assert message_group_key(message(text="  ")) is None
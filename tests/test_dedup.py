@@ -0,0 +1,59 @@
+"""
+Индекс update_id: повторы отсекаются и после перезапуска, и между процессами,
+а отклонённое обновление можно доставить снова.
+"""
+
+from dedup import UpdateDedup
+
+
+def test_duplicate_is_rejected(tmp_path):
+    dedup = UpdateDedup(path=str(tmp_path / "updates.db"))
+    assert dedup.check(1)
+    assert not dedup.check(1)
+    assert dedup.check(2)
+    assert dedup.stats()["duplicates"] == 1
+
+
+def test_index_survives_restart(tmp_path):
+    path = str(tmp_path / "updates.db")
+    assert UpdateDedup(path=path).check(10)
+    restarted = UpdateDedup(path=path)
+    assert not restarted.check(10)
+    assert restarted.check(11)
+
+
+def test_index_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "updates.db")
+    first, second = UpdateDedup(path=path), UpdateDedup(path=path)
+    assert first.check(5)
+    assert not second.check(5)
+
+
+def test_forget_allows_redelivery(tmp_path):
+    path = str(tmp_path / "updates.db")
+    first, second = UpdateDedup(path=path), UpdateDedup(path=path)
+    assert first.check(7)
+    # Очередь была полна - обновление не принято, Telegram доставит его снова
+    first.forget(7)
+    assert second.check(7)
+    assert not first.check(7)
+
+
+def test_memory_index_is_bounded():
+    dedup = UpdateDedup(path=None, capacity=2)
+    for update_id in (1, 2, 3):
+        assert dedup.check(update_id)
+    assert dedup.stats()["tracked"] == 2
+    assert not dedup.check(3)
+    # Самый старый вытеснен из памяти, а базы нет
+    assert dedup.check(1)
+
+
+def test_database_is_pruned_to_capacity(tmp_path):
+    path = str(tmp_path / "updates.db")
+    dedup = UpdateDedup(path=path, capacity=10)
+    for update_id in range(25):
+        assert dedup.check(update_id)
+    restarted = UpdateDedup(path=path, capacity=10)
+    assert not restarted.check(24)
+    assert restarted.check(0)
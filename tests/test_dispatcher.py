@@ -0,0 +1,127 @@
+"""
+Очередь обработки: порядок внутри чата и политики переполнения очереди чата.
+"""
+
+import time
+import threading
+
+from dispatcher import ChatDispatcher
+from conftest import wait_until
+
+
+def blocked_dispatcher(policy, merge=None, max_pending=1000):
+    """Диспетчер, у которого первое задание чата 1 держит воркер до gate.set()"""
+    gate = threading.Event()
+    handled, shed = [], []
+
+    def handler(job):
+        if job == "first":
+            gate.wait(5)
+        handled.append(job)
+
+    dispatcher = ChatDispatcher(handler, workers=2, max_pending=max_pending, max_chat_pending=2,
+                                overflow=policy, merge=merge,
+                                on_shed=lambda chat_id, job: shed.append((chat_id, job)))
+    assert dispatcher.submit(1, "first")
+    wait_until(lambda: dispatcher.stats()["in_flight"] == 1)
+    return dispatcher, gate, handled, shed
+
+
+def finish(dispatcher, gate):
+    gate.set()
+    assert dispatcher.wait_idle(5)
+    dispatcher.shutdown()
+
+
+def test_busy_policy_sheds_new_job():
+    dispatcher, gate, handled, shed = blocked_dispatcher("busy")
+    for job in ("a", "b", "c"):
+        assert dispatcher.submit(1, job)
+    finish(dispatcher, gate)
+    assert handled == ["first", "a", "b"]
+    assert shed == [(1, "c")]
+    assert dispatcher.stats()["shed"] == 1
+
+
+def test_drop_oldest_policy_sheds_oldest_pending_job():
+    dispatcher, gate, handled, shed = blocked_dispatcher("drop_oldest")
+    for job in ("a", "b", "c"):
+        assert dispatcher.submit(1, job)
+    finish(dispatcher, gate)
+    assert handled == ["first", "b", "c"]
+    assert shed == [(1, "a")]
+
+
+def test_merge_policy_joins_with_last_pending_job():
+    merge = lambda last, new: None if "x" in (last, new) else last + new  # noqa: E731
+    dispatcher, gate, handled, shed = blocked_dispatcher("merge", merge=merge)
+    for job in ("a", "b", "c", "x"):
+        assert dispatcher.submit(1, job)
+    finish(dispatcher, gate)
+    # Не склеилось - как busy
+    assert handled == ["first", "a", "bc"]
+    assert shed == [(1, "x")]
+    assert dispatcher.stats()["merged"] == 1
+
+
+def test_overflow_of_one_chat_does_not_affect_others():
+    dispatcher, gate, handled, shed = blocked_dispatcher("busy")
+    for job in ("a", "b", "c"):
+        dispatcher.submit(1, job)
+    assert dispatcher.submit(2, "other")
+    wait_until(lambda: "other" in handled)
+    finish(dispatcher, gate)
+    assert shed == [(1, "c")]
+
+
+def test_global_limit_rejects_submit():
+    dispatcher, gate, handled, shed = blocked_dispatcher("busy", max_pending=1)
+    assert dispatcher.submit(1, "a")
+    assert not dispatcher.submit(2, "b")
+    finish(dispatcher, gate)
+    assert handled == ["first", "a"]
+    assert shed == []
+
+
+def test_updates_of_one_chat_are_handled_in_order():
+    handled = {}
+    lock = threading.Lock()
+    running = set()
+    overlaps = []
+
+    def handler(job):
+        chat_id, n = job
+        with lock:
+            if chat_id in running:
+                overlaps.append(job)
+            running.add(chat_id)
+        time.sleep(0.001 * (n % 3))
+        with lock:
+            running.discard(chat_id)
+            handled.setdefault(chat_id, []).append(n)
+
+    dispatcher = ChatDispatcher(handler, workers=4)
+    for n in range(30):
+        for chat_id in (1, 2, 3):
+            assert dispatcher.submit(chat_id, (chat_id, n))
+    assert dispatcher.wait_idle(10)
+    dispatcher.shutdown()
+    assert handled == {chat_id: list(range(30)) for chat_id in (1, 2, 3)}
+    # Один чат никогда не обрабатывается двумя воркерами сразу
+    assert overlaps == []
+
+
+def test_handler_error_does_not_stop_the_chat():
+    handled = []
+
+    def handler(job):
+        if job == "bad":
+            raise ValueError(job)
+        handled.append(job)
+
+    dispatcher = ChatDispatcher(handler, workers=2)
+    for job in ("a", "bad", "b"):
+        dispatcher.submit(1, job)
+    assert dispatcher.wait_idle(5)
+    dispatcher.shutdown()
+    assert handled == ["a", "b"]
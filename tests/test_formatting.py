@@ -0,0 +1,90 @@
+"""
+Подготовка и отправка частей ответа: разметка, которая не прошла проверку,
+должна уходить простым текстом без parse_mode.
+"""
+
+from formatting import render_chunks, split_text, is_valid_html, utf16_len, deliver_text, deliver_chunks
+
+BROKEN = "x < y and **a _b** c_"
+
+
+def test_render_chunks_escapes_and_converts():
+    [(plain, formatted)] = render_chunks("**жирный** и x < y")
+    assert plain == "**жирный** и x < y"
+    assert formatted == "<b>жирный</b> и x &lt; y"
+    assert is_valid_html(formatted)
+
+
+def test_render_chunks_falls_back_on_bad_nesting():
+    [(plain, formatted)] = render_chunks(BROKEN)
+    assert plain == BROKEN
+    assert formatted is None
+
+
+def test_split_text_keeps_code_blocks_within_limit():
+    text = "Абзац\n\n```py\n" + "x = 1\n" * 2000 + "```"
+    chunks = split_text(text, limit=4096)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 4096 for chunk in chunks)
+    assert all(chunk.count("```") % 2 == 0 for chunk in chunks)
+
+
+class Recorder:
+    """send(текст, parse_mode) для deliver_*: запоминает отправки, HTML можно отклонять"""
+
+    def __init__(self, reject_html=False):
+        self.sent = []
+        self.fallbacks = 0
+        self.reject_html = reject_html
+
+    def __call__(self, text, parse_mode):
+        self.sent.append((text, parse_mode))
+        return not (self.reject_html and parse_mode == "HTML")
+
+    def fallback(self):
+        self.fallbacks += 1
+
+
+def test_deliver_text_sends_invalid_markup_as_plain_text():
+    send = Recorder()
+    assert deliver_text(BROKEN, send, on_fallback=send.fallback)
+    assert send.sent == [(BROKEN, None)]
+    assert send.fallbacks == 0
+
+
+def test_deliver_chunks_retries_rejected_html_without_parse_mode():
+    send = Recorder(reject_html=True)
+    assert deliver_chunks(render_chunks("**a**"), send, on_fallback=send.fallback)
+    assert send.sent == [("<b>a</b>", "HTML"), ("**a**", None)]
+    assert send.fallbacks == 1
+
+
+def test_deliver_text_keeps_callers_parse_mode():
+    send = Recorder()
+    assert deliver_text("⏳", send, parse_mode=None)
+    assert send.sent == [("⏳", None)]
+
+
+def test_split_text_fence_without_newline_terminates():
+    text = "```" + "x" * 5000
+    chunks = split_text(text, limit=4096)
+    assert "".join(chunks).count("x") == 5000
+    assert all(len(chunk) <= 4096 for chunk in chunks)
+    assert all(chunk.count("```") % 2 == 0 for chunk in chunks)
+    assert all(len(chunk) <= 10 for chunk in split_text("```py\n" + "y" * 50, limit=10))
+
+
+def test_render_chunks_ignores_placeholder_marks_in_text():
+    [(plain, formatted)] = render_chunks("a \x005\x00 **b**")
+    assert plain == "a \x005\x00 **b**"
+    assert formatted == "a 5 <b>b</b>"
+
+
+def test_split_text_counts_utf16_units():
+    text = "😀" * 4000
+    chunks = split_text(text, limit=4096)
+    assert len(chunks) == 2
+    assert all(utf16_len(chunk) <= 4096 for chunk in chunks)
+    assert "".join(chunks) == text
+    code = split_text("```\n" + "😀" * 3000 + "\n```", limit=4096)
+    assert all(utf16_len(chunk) <= 4096 for chunk in code)
@@ -0,0 +1,50 @@
+"""
+Пакетная запись истории: параллельные flush() не обгоняют друг друга
+и не возвращаются раньше, чем записан чужой пакет.
+"""
+
+import threading
+
+from history_store import HistoryStore, MemoryHistoryBackend
+
+
+class SlowBackend(MemoryHistoryBackend):
+    """Первая запись ждёт, пока тест её не отпустит"""
+
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.batches = []
+
+    def save_many(self, items):
+        if not self.batches:
+            self.started.set()
+            self.release.wait(5)
+        self.batches.append(dict(items))
+        super().save_many(items)
+
+
+def test_concurrent_flushes_are_serialized():
+    backend = SlowBackend()
+    store = HistoryStore(backend, max_messages=10, flush_interval=3600)
+    a, b = {"role": "user", "content": "a"}, {"role": "user", "content": "b"}
+
+    store.append(1, a)
+    first = threading.Thread(target=store.flush)
+    first.start()
+    assert backend.started.wait(5)
+
+    store.append(1, b)
+    second = threading.Thread(target=store.flush)
+    second.start()
+    second.join(0.2)
+    # Пакет первого потока ещё не записан - второй flush() ждёт его
+    assert second.is_alive()
+
+    backend.release.set()
+    first.join(5)
+    second.join(5)
+    assert backend.batches == [{1: [a]}, {1: [a, b]}]
+    assert backend.load(1) == [a, b]
+    store.close()
@@ -0,0 +1,77 @@
+"""
+Страхующие запросы: слот допуска держится, пока идут все попытки,
+а при занятых потоках страховка не отправляется.
+"""
+
+import time
+import threading
+
+import model_router
+from model_router import ModelRouter
+from admission import AdmissionController
+from conftest import wait_until
+
+
+def fast_hedging(monkeypatch):
+    monkeypatch.setattr(model_router, "HEDGE_MIN_DELAY", 0.01)
+    monkeypatch.setattr(model_router, "HEDGE_DEFAULT_DELAY", 0.01)
+
+
+def test_slot_is_held_until_losing_hedge_finishes(monkeypatch):
+    fast_hedging(monkeypatch)
+    gate = threading.Event()
+    controller = AdmissionController(global_limit=2)
+
+    def request(model, attempt):
+        if model == "slow":
+            gate.wait(5)
+            return "late"
+        return "ok"
+
+    router = ModelRouter("test", ["slow", "fast"])
+    with controller.slot(1) as slot:
+        assert router.call(request, on_settled=controller.hold(slot)) == "ok"
+    # Проигравшая попытка ещё идёт - слот занят
+    assert controller.stats()["active"] == 1
+    gate.set()
+    wait_until(lambda: controller.stats()["active"] == 0)
+
+
+def test_slot_is_released_when_there_is_nothing_left():
+    controller = AdmissionController(global_limit=1)
+    router = ModelRouter("test", ["only"])
+    with controller.slot(1) as slot:
+        assert router.call(lambda model, attempt: "ok", on_settled=controller.hold(slot)) == "ok"
+        assert controller.stats()["active"] == 0
+
+
+def test_no_hedge_when_model_threads_are_busy(monkeypatch):
+    fast_hedging(monkeypatch)
+    monkeypatch.setattr(model_router, "ROUTER_THREADS", 1)
+    called = []
+    gate = threading.Event()
+
+    def request(model, attempt):
+        called.append(model)
+        gate.wait(0.3)
+        return "ok"
+
+    router = ModelRouter("test", ["a", "b"])
+    assert router.call(request) == "ok"
+    assert called == ["a"]
+
+
+def test_no_hedge_after_stream_has_started(monkeypatch):
+    fast_hedging(monkeypatch)
+    called = []
+
+    def request(model, attempt):
+        called.append(model)
+        # Первый кусок пришёл сразу, а генерация идёт дольше задержки страховки
+        assert attempt.claim()
+        time.sleep(0.2)
+        return "ok"
+
+    router = ModelRouter("test", ["a", "b"])
+    assert router.call(request, streaming=True) == "ok"
+    assert called == ["a"]
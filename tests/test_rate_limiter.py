@@ -0,0 +1,45 @@
+"""
+Исходящие запросы без ожидания: отправитель не ждёт лимита чата,
+из ждущих правок остаётся последняя, а отменённая не отправляется.
+"""
+
+import time
+
+import rate_limiter
+from rate_limiter import OutboundScheduler, PRIORITY_EDIT
+from conftest import wait_until
+
+GROUP = -100123
+
+
+def drained_group(monkeypatch):
+    """Планировщик, у которого лимит группы исчерпан, а следующий токен через ~0.5 с"""
+    monkeypatch.setattr(rate_limiter, "GROUP_RATE", 2)
+    scheduler = OutboundScheduler()
+    for _ in range(int(rate_limiter.GROUP_BURST)):
+        scheduler.call(GROUP, lambda: None)
+    return scheduler
+
+
+def test_submit_latest_does_not_wait_and_keeps_only_the_last(monkeypatch):
+    scheduler = drained_group(monkeypatch)
+    sent = []
+    started = time.monotonic()
+    for text in ("a", "ab", "abc"):
+        scheduler.submit_latest(GROUP, lambda text=text: sent.append(text), PRIORITY_EDIT)
+    assert time.monotonic() - started < 0.1
+    wait_until(lambda: sent)
+    time.sleep(0.6)
+    assert sent == ["abc"]
+    assert scheduler.stats()["dropped_edits"] == 2
+
+
+def test_cancel_latest_drops_pending_edit(monkeypatch):
+    scheduler = drained_group(monkeypatch)
+    sent = []
+    scheduler.submit_latest(GROUP, lambda: sent.append("edit"), PRIORITY_EDIT)
+    scheduler.cancel_latest(GROUP, PRIORITY_EDIT)
+    scheduler.call(GROUP, lambda: sent.append("final"))
+    time.sleep(0.1)
+    assert sent == ["final"]
+    assert scheduler.stats()["queue_depth"] == 0
@@ -0,0 +1,33 @@
+"""
+Локальная оценка числа токенов без запросов к API.
+Точность не нужна - важно, чтобы размер промпта был предсказуемым.
+"""
+
+from functools import lru_cache
+
+MESSAGE_OVERHEAD = 4  # Служебные токены роли и разделителей
+IMAGE_TOKENS = 85  # Условная цена картинки в истории
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text):
+    """Оценка токенов: ~4 символа латиницы или ~2.5 символа кириллицы на токен"""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) * 2 // 5 + 1
+
+
+def count_message_tokens(message):
+    """Оценка токенов одного сообщения в формате OpenAI"""
+    content = message.get("content")
+    if isinstance(content, list):
+        tokens = 0
+        for part in content:
+            if part.get("type") == "text":
+                tokens += count_tokens(part.get("text", ""))
+            else:
+                tokens += IMAGE_TOKENS
+    else:
+        tokens = count_tokens(content or "")
+    return tokens + MESSAGE_OVERHEAD
@@ -0,0 +1,9 @@
+"""
+Точка входа WSGI для продакшена:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+from bot import app
+
+__all__ = ["app"]